@@ -1,9 +1,11 @@
-from numpy import ndarray, uint8, ones, array
+from numpy import ndarray, uint8, ones, stack, ascontiguousarray, empty_like, bincount, array, float64, int32
 from os import path, getenv
 from PIL import Image
-from cv2 import dilate, findContours, contourArea, boundingRect, rectangle, putText
-from cv2 import RETR_EXTERNAL, CHAIN_APPROX_SIMPLE, FONT_HERSHEY_SIMPLEX
-from typing import Generator, Any
+from cv2 import dilate, compare, connectedComponentsWithStats, rectangle, putText, imread, cvtColor
+from cv2 import CC_STAT_LEFT, CC_STAT_TOP, CC_STAT_WIDTH, CC_STAT_HEIGHT, CC_STAT_AREA
+from cv2 import CMP_EQ, FONT_HERSHEY_SIMPLEX, IMREAD_COLOR, COLOR_BGR2RGB, INTER_LANCZOS4, INTER_NEAREST
+from typing import Generator, Any, Iterable
+from concurrent.futures import ThreadPoolExecutor
 from modules.image_rectification import ImageRectification
 from modules.image_segmentation import ImageSegmentation
 from modules.metrics_estimation import MetricsEstimation
@@ -11,18 +13,36 @@ from modules.path_tool import get_file_placement_path
 
 
 class ApexPipeline:
-    def __init__(self, undistort_m_pixel_ratio: float) -> None:
+    def __init__(self, undistort_m_pixel_ratio: float, backend: str = "pytorch", segmentation_imgsz: int = 640) -> None:
         """Initialize the pipeline with the given parameters.
         Args:
             undistort_m_pixel_ratio (float): Ratio of meters per pixel in the width direction for undistortion.
+            backend (str, optional): Segmentation inference backend, one of 'pytorch', 'onnx' or 'engine' (TensorRT). Defaults to 'pytorch'.
+            segmentation_imgsz (int, optional): Size the image is downsampled to for segmentation, multiple of 32. Defaults to 640.
         """
         self.undistort_m_pixel_ratio = undistort_m_pixel_ratio
-        self.detections_metrics = list()
+        self.backend = backend
+        self.segmentation_imgsz = segmentation_imgsz
+        # Each detection metrics, as one array per field
+        self.detections_metrics = self.build_detections_metrics()
         self.image_total_metrics = dict()
         # Classes to keep track of metrics
         self.desired_classes = ["macrofita", "sedimento", "tronco"]
         # Segmented image to show after processing is done
         self.segmented_image = None
+        # Kernel used to dilate the class masks before extracting boxes
+        self.dilate_kernel = ones((5, 5), uint8)
+        # Rectification output buffers, reused across runs when the output size does not change
+        self.rectified_image_buffer = None
+        self.rectified_mask_buffer = None
+        self.segmented_image_buffer = None
+        # Models are kept across runs, the segmentation one is loaded on the first run
+        self.image_segmentation = None
+        # Start loading the depth model in the background, so it overlaps the image segmentation
+        executor = ThreadPoolExecutor(max_workers=1)
+        self.metrics_estimation_future = executor.submit(
+            MetricsEstimation, model_local_path=get_file_placement_path("models/distill_any_depth/22c685bb9cd0d99520f2438644d2a9ad2cea41dc"))
+        executor.shutdown(wait=False)
 
     def set_barrier_dimensions(self, barrier_dimensions: dict) -> None:
         """Set the barrier dimensions for the pipeline.
@@ -31,50 +51,96 @@ class ApexPipeline:
         """
         self.barrier_dimensions = barrier_dimensions
 
-    def get_boxes_from_image(self, image: ndarray, class_id: int) -> list:
+    def get_boxes_from_image(self, image: ndarray, class_id: int, binary: ndarray = None) -> list:
         """Get bouding boxes and confidences from the image.
 
         Args:
             image (ndarray): input bounding box with the codes given by semantic segmentation class
             class_id (int): the class id to get the boxes from
+            binary (ndarray, optional): uint8 buffer with the image shape to reuse for the class mask. Defaults to None.
 
         Returns:
             list: boxes for this class id
         """
-        binary = (image == class_id).astype(uint8) * 255
+        image = ascontiguousarray(image, dtype=uint8)
+        if binary is None:
+            binary = empty_like(image)
+        # Binary 0/255 mask for the class in a single pass over the image
+        compare(image, class_id, CMP_EQ, dst=binary)
         # Dilate the binary image to fill in gaps
-        kernel = ones((5, 5), uint8)
-        binary = dilate(binary, kernel, iterations=1)
-        contours, _ = findContours(
-            binary, RETR_EXTERNAL, CHAIN_APPROX_SIMPLE)
-        boxes = []
-        for contour in contours:
-            # if area is too small, skip it
-            if contourArea(contour) < 100:
-                continue
-            # Get the bounding box for the contour
-            x, y, w, h = boundingRect(contour)
-            boxes.append([x, y, x + w, y + h])
+        dilate(binary, self.dilate_kernel, dst=binary, iterations=1)
+        # Get every connected component bounding box and area in a single call, skipping the background label
+        _, _, stats, _ = connectedComponentsWithStats(binary, connectivity=8)
+        stats = stats[1:]
+        # If area is too small, skip it
+        stats = stats[stats[:, CC_STAT_AREA] >= 100]
+        xs, ys = stats[:, CC_STAT_LEFT], stats[:, CC_STAT_TOP]
+        ws, hs = stats[:, CC_STAT_WIDTH], stats[:, CC_STAT_HEIGHT]
+
+        return stack([xs, ys, xs + ws, ys + hs], axis=1).tolist()
 
-        return boxes
+    def get_boxes_per_class(self, image: ndarray, class_ids: dict) -> dict:
+        """Get the bounding boxes for several classes at once, sharing the same binary buffer.
 
-    def run(self, image_path: str) -> Generator[float, str, Any]:
+        Args:
+            image (ndarray): input image with the codes given by semantic segmentation class
+            class_ids (dict): the classes to get the boxes from, in the form of 'name': code(int)
+
+        Returns:
+            dict: boxes for each class name
+        """
+        image = ascontiguousarray(image, dtype=uint8)
+        binary = empty_like(image)
+        # Count the pixels of every class in a single pass, so the classes absent from the image are skipped
+        class_pixel_counts = bincount(image.ravel(), minlength=256)
+        return {class_name: self.get_boxes_from_image(image=image, class_id=class_id, binary=binary)
+                if class_pixel_counts[class_id] > 0 else []
+                for class_name, class_id in class_ids.items()}
+
+    def load_image(self, image_path: str) -> ndarray:
+        """Load the image in RGB, as the rest of the pipeline expects.
+
+        Args:
+            image_path (str): Path to the image.
+
+        Raises:
+            ValueError: If the image could not be read.
+
+        Returns:
+            ndarray: RGB image
+        """
+        image = imread(image_path, IMREAD_COLOR)
+        if image is None:
+            raise ValueError(f"Could not read the image at {image_path}.")
+        return cvtColor(image, COLOR_BGR2RGB)
+
+    def run(self, image_path: str, image: ndarray = None) -> Generator[float, str, Any]:
         """Run the pipeline with the given parameters.
         Args:
             image_path (str): Path to the image.
+            image (ndarray, optional): The image already loaded in RGB, read from image_path if not given. Defaults to None.
         """
         # If there are no dimensions set yet, raise an error
         if not hasattr(self, 'barrier_dimensions'):
             raise ValueError(
                 "Barrier dimensions must be set before running the pipeline.")
 
-        # Read image into numpy array
+        # Clear the results from any previous run
+        self.detections_metrics = self.build_detections_metrics()
+        self.image_total_metrics = dict()
+        self.segmented_image = None
+
+        # Read image into numpy array, in RGB as the rest of the pipeline expects
         yield 0, "Starting the pipeline by segmenting the image..."
-        image = array(Image.open(image_path))
+        if image is None:
+            image = self.load_image(image_path=image_path)
 
         # Lets segment the image to find the collumns
-        image_segmentation = ImageSegmentation(model_path=get_file_placement_path(
-            "models/image_segmentation/weights/best.pt"))
+        if self.image_segmentation is None:
+            self.image_segmentation = ImageSegmentation(model_path=get_file_placement_path(
+                "models/image_segmentation/weights/best.pt"), backend=self.backend, imgsz=self.segmentation_imgsz)
+        image_segmentation = self.image_segmentation
+        image_segmentation.reset_detections()
         collumn_boxes = []
         barrier_boxes = []
         if image_segmentation.segment_classes(image=image):
@@ -95,63 +161,133 @@ class ApexPipeline:
             barrier_dimensions=self.barrier_dimensions, undistort_meters_pixel_ratio=self.undistort_m_pixel_ratio)
         image_rectification.set_detected_boxes(
             collumn_boxes=collumn_boxes, barrier_boxes=barrier_boxes)
-        rectified_image = image_rectification.snip_rectify_image(image=image)
-        rectified_mask = image_rectification.snip_rectify_image(
-            image=image_segmentation.get_detections_mask())
+        # The sections are computed once for both, and the class ids mask must not be interpolated
+        rectified_image, rectified_mask = image_rectification.snip_rectify_images(
+            images=[image, image_segmentation.get_detections_mask()],
+            interpolations=[INTER_LANCZOS4, INTER_NEAREST],
+            outs=[self.rectified_image_buffer, self.rectified_mask_buffer])
         meter_pixel_ratios = image_rectification.get_meters_pixel_ratio()
         self.segmented_image = image_rectification.snip_rectify_image(
-            image_segmentation.get_masked_image())
+            image=image_segmentation.get_masked_image(), out=self.segmented_image_buffer)
+        self.rectified_image_buffer = rectified_image
+        self.rectified_mask_buffer = rectified_mask
+        self.segmented_image_buffer = self.segmented_image
         yield 60, "Image rectified successfully. Starting metrics estimation..."
 
-        # Lets estimate the metrics
-        metrics_estimation = MetricsEstimation(model_local_path=get_file_placement_path("models/distill_any_depth/22c685bb9cd0d99520f2438644d2a9ad2cea41dc"),
-                                               m_per_pixel=meter_pixel_ratios, class_ids=class_ids)
+        # Lets estimate the metrics, waiting for the depth model to finish loading if needed
+        metrics_estimation = self.metrics_estimation_future.result()
+        metrics_estimation.set_m_per_pixel(m_per_pixel=meter_pixel_ratios)
+        metrics_estimation.set_class_ids(class_ids=class_ids)
+        metrics_estimation.reset_grid_plane_model()
+        # Get the boxes of every desired class from the rectified global mask
+        boxes_per_class = self.get_boxes_per_class(
+            image=rectified_mask, class_ids={c: class_ids[c] for c in self.desired_classes})
+        # Estimate every detection at once, so the depth model runs for all the boxes together
+        candidate_classes, candidate_boxes = [], []
+        for desired_class in self.desired_classes:
+            for box in boxes_per_class[desired_class]:
+                candidate_classes.append(desired_class)
+                candidate_boxes.append(box)
+        areas_volumes = metrics_estimation.estimate_blocking_areas_volumes(
+            image=rectified_image, boxes=candidate_boxes, mask=rectified_mask, class_names=candidate_classes, debug=False)
+        detections_areas, detections_volumes, detections_boxes, detections_classes = [], [], [], []
         total_area, total_volume = 0, 0
+        colormap = image_segmentation.get_colormap()
+        class_colors = dict()
         for k, desired_class in enumerate(self.desired_classes):
             pct = 60 + (k + 1) * 10
-            # Get the global mask and macrofitas boxes
-            boxes = self.get_boxes_from_image(
-                image=rectified_mask, class_id=class_ids[desired_class])
-            if not boxes:
+            if not boxes_per_class[desired_class]:
                 yield pct, f"No {desired_class} detected in the image."
                 continue
-            for box in boxes:
-                # Estimate the volume of each macrofita group
-                area, volume = metrics_estimation.estimate_blocking_area_volume(
-                    image=rectified_image, box=box, mask=rectified_mask, class_name=desired_class, debug=False)
-                if area < 10:
+            # Box color, converted once to the tuple OpenCV expects
+            class_colors[desired_class] = tuple(
+                int(c) for c in colormap[class_ids[desired_class]])
+            for box, box_class, (area, volume) in zip(candidate_boxes, candidate_classes, areas_volumes):
+                if box_class != desired_class or area < 10:
                     continue
-                # Add the detection metrics to the dictionary
-                self.detections_metrics.append(
-                    {"area": area, "volume": volume, "box": box, "class": desired_class})
+                # Add the detection metrics to the lists
+                detections_areas.append(area)
+                detections_volumes.append(volume)
+                detections_boxes.append(box)
+                detections_classes.append(desired_class)
                 total_area += area
                 total_volume += volume
             self.image_total_metrics[desired_class] = {
                 "area": total_area, "volume": total_volume}
             yield pct, f"{desired_class} metrics estimated successfully."
+        self.detections_metrics = self.build_detections_metrics(
+            areas=detections_areas, volumes=detections_volumes, boxes=detections_boxes, classes=detections_classes)
 
         yield pct, "Metrics estimation completed successfully. Generating image with detections..."
         # Draw the codes in the image for each detection
-        colormap = image_segmentation.get_colormap()
-        for d, detection in enumerate(self.detections_metrics):
-            box = detection["box"]
+        for d, (box, box_class) in enumerate(zip(self.detections_metrics["box"].tolist(),
+                                                 self.detections_metrics["class"].tolist())):
             pt1, pt2 = (box[0], box[1]), (box[2], box[3])
             pt3 = ((box[0] + box[2]) // 2, (box[1] + box[3]) // 2)
             # Draw the bounding box and text on the image
-            class_id = class_ids[detection["class"]]
-            color = tuple(int(c) for c in colormap[class_id])
+            color = class_colors[box_class]
             rectangle(self.segmented_image, pt1, pt2, color, 2)
             putText(self.segmented_image, str(d), pt3,
                     FONT_HERSHEY_SIMPLEX, 2, (0, 0, 255), 2)
         yield 100, "Masked image with detections was generated successfully."
 
+    def run_stream(self, image_paths: Iterable[str]) -> Generator[tuple, None, None]:
+        """Run the pipeline for several images, loading the next image in the background while the current one is processed.
+        Args:
+            image_paths (Iterable[str]): Paths to the images.
+
+        Yields:
+            tuple: image path, progress percentage and status message. The metrics and the segmented
+            image of an image are available until the first state of the next one is yielded.
+        """
+        image_paths = iter(image_paths)
+        image_path = next(image_paths, None)
+        if image_path is None:
+            return
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            image_future = executor.submit(self.load_image, image_path)
+            while image_path is not None:
+                image = image_future.result()
+                # Start loading the next image before processing the current one
+                next_image_path = next(image_paths, None)
+                if next_image_path is not None:
+                    image_future = executor.submit(
+                        self.load_image, next_image_path)
+                for state in self.run(image_path=image_path, image=image):
+                    yield image_path, state[0], state[1]
+                image_path = next_image_path
+
+    @staticmethod
+    def build_detections_metrics(areas: list = (), volumes: list = (), boxes: list = (), classes: list = ()) -> dict:
+        """Build the detections metrics with one array per field, indexed by the detection number.
+        Args:
+            areas (list, optional): Area of each detection in square meters. Defaults to no detections.
+            volumes (list, optional): Volume of each detection in cubic meters. Defaults to no detections.
+            boxes (list, optional): Box of each detection as [x1, y1, x2, y2]. Defaults to no detections.
+            classes (list, optional): Class name of each detection. Defaults to no detections.
+
+        Returns:
+            dict: The 'area', 'volume', 'box' (N x 4) and 'class' arrays.
+        """
+        return {"area": array(areas, dtype=float64), "volume": array(volumes, dtype=float64),
+                "box": array(boxes, dtype=int32).reshape(-1, 4), "class": array(classes, dtype=str)}
+
     def get_detections_metrics(self) -> tuple:
         """Get the detected metrics.
         Returns:
-            tuple: Each detection metrics and total per class.
+            tuple: Each detection metrics, as one array per field, and total per class.
         """
         return self.detections_metrics, self.image_total_metrics
 
+    def get_segmented_ndarray(self) -> ndarray:
+        """Get the segmented image buffer, without converting it.
+        Returns:
+            ndarray: Contiguous RGB segmented image, or None if no image was generated.
+        """
+        if self.segmented_image is None:
+            return None
+        return ascontiguousarray(self.segmented_image)
+
     def get_segmented_image(self) -> Image.Image:
         """Get the segmented image.
         Returns:
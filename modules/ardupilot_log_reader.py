@@ -1,21 +1,29 @@
 from pymavlink import mavutil
 from datetime import datetime, timedelta
-from utm import from_latlon
+from utm import latlon_to_zone_number
+from pyproj import Transformer
 import numpy as np
 
 
+# Layout of the GPS data read from the log, one contiguous column per field
+GPS_DATA_DTYPE = np.dtype([("latitude", np.float64), ("longitude", np.float64), ("altitude", np.float64),
+                           ("timestamp", np.float64), ("TimeUS", np.int64)])
+
+
 class ArdupilotLogReader:
     def __init__(self) -> None:
         """Constructor for the ArdupilotLogReader class.
         """
         self.log_file_path = ''
-        self.gps_data = []
+        self.gps_data = np.empty(0, dtype=GPS_DATA_DTYPE)
         # Adjust for leap seconds (current offset as of 2024 is 18 seconds)
         self.leap_seconds = 18
         # GPS epoch is 6th January 1980
         self.gps_epoch = datetime(1980, 1, 6)
         # Missions in the log
         self.missions_in_log = []
+        # Transformers from latitude and longitude to each UTM zone used, by EPSG code
+        self.utm_transformers = dict()
 
     def set_log_file_path(self, file_path: str) -> None:
         """Sets the ardupilot log file path to be read.
@@ -45,6 +53,49 @@ class ArdupilotLogReader:
             timedelta(seconds=self.leap_seconds)
         return gps_time_utc.timestamp()
 
+    def calculate_utc_timestamps(self, timestamps_ms: np.ndarray, gps_weeks: np.ndarray) -> np.ndarray:
+        """Calculates the UTC timestamps from arrays of GPS timestamps and weeks at once.
+
+        Args:
+            timestamps_ms (np.ndarray): the timestamps in milliseconds
+            gps_weeks (np.ndarray): the GPS weeks
+
+        Returns:
+            np.ndarray: the UTC timestamps
+        """
+        if len(timestamps_ms) == 0:
+            return np.empty(0, dtype=np.float64)
+        gps_seconds = gps_weeks * 604800.0 + timestamps_ms * 1e-3 - self.leap_seconds
+        # Same as calculate_utc_timestamp, with the epoch and time zone offset taken once from the first row's date
+        epoch_timestamp = self.calculate_utc_timestamp(
+            float(timestamps_ms[0]), int(gps_weeks[0])) - gps_seconds[0]
+        return epoch_timestamp + gps_seconds
+
+    def latlon_to_utm(self, latitudes: np.ndarray, longitudes: np.ndarray) -> tuple:
+        """Converts the latitudes and longitudes to UTM coordinates at once, in the zone of the valid fixes.
+
+        Args:
+            latitudes (np.ndarray): the latitudes in degrees
+            longitudes (np.ndarray): the longitudes in degrees
+
+        Returns:
+            tuple: the UTM easts and norths
+        """
+        # Rows without a GPS fix come as 0 latitude and 0 longitude, so they can not choose the zone
+        valid_fixes = (latitudes != 0) | (longitudes != 0)
+        if not valid_fixes.any():
+            valid_fixes = np.ones_like(latitudes, dtype=bool)
+        # The median of the valid fixes keeps a single bad sample from changing the zone or the hemisphere
+        reference_latitude = float(np.median(latitudes[valid_fixes]))
+        reference_longitude = float(np.median(longitudes[valid_fixes]))
+        # WGS84 UTM zones are EPSG 326xx in the northern hemisphere and 327xx in the southern one
+        zone_number = latlon_to_zone_number(reference_latitude, reference_longitude)
+        utm_epsg = (32600 if reference_latitude >= 0 else 32700) + zone_number
+        if utm_epsg not in self.utm_transformers:
+            self.utm_transformers[utm_epsg] = Transformer.from_crs(
+                "EPSG:4326", f"EPSG:{utm_epsg}", always_xy=True)
+        return self.utm_transformers[utm_epsg].transform(longitudes, latitudes)
+
     def read_data_from_log(self) -> None:
         """Generates the data from the log file.
         """
@@ -52,80 +103,73 @@ class ArdupilotLogReader:
             return
         if len(self.gps_data) > 0 and len(self.missions_in_log) > 0:
             return
-        # First lets read the GPS data as necessary
-        log_file = mavutil.mavlink_connection(
-            self.log_file_path, robust_parsing=True)
-        while True:
-            msg = log_file.recv_match(type='GPS', blocking=True)
-            if msg is None:
-                break
-            self.gps_data.append({
-                "latitude": msg.Lat,
-                "longitude": msg.Lng,
-                "altitude": msg.Alt,
-                "timestamp": self.calculate_utc_timestamp(msg.GMS, msg.GWk),
-                "TimeUS": msg.TimeUS
-            })
-        log_file.close()
-
-        # Now look for the CMD messages that contain mission points
-        mission_command_messages = []
+        # Read the GPS data and the CMD messages that contain mission points in a single pass over the log
+        gps_rows = []
+        gps_weeks = []
+        # Only the timestamp and coordinates of the mission commands are kept, not the parsed messages
+        mission_command_rows = []
         log_file = mavutil.mavlink_connection(
             self.log_file_path, robust_parsing=True)
+        # Bind the methods called for every message once, outside the loop
+        recv_match = log_file.recv_match
+        append_gps_row = gps_rows.append
+        append_gps_week = gps_weeks.append
+        append_mission_command_row = mission_command_rows.append
+        message_types = {'GPS', 'CMD'}
         while True:
-            msg = log_file.recv_match(type='CMD', blocking=True)
+            msg = recv_match(type=message_types, blocking=True)
             if msg is None:
                 break
-            if msg.Lat != 0 and msg.Lng != 0 and msg.Frame == 3 and msg.CId == 16:
-                mission_command_messages.append(msg)
+            if msg.get_type() == 'GPS':
+                # Keep the GPS milliseconds in the timestamp column, converted to UTC for the whole log below
+                append_gps_row((msg.Lat, msg.Lng, msg.Alt, msg.GMS, msg.TimeUS))
+                append_gps_week(msg.GWk)
+            # Waypoint commands are the rarest match, check them before reading the coordinates
+            elif msg.CId == 16 and msg.Frame == 3 and msg.Lat != 0 and msg.Lng != 0:
+                append_mission_command_row((msg.TimeUS, msg.Lat, msg.Lng))
         log_file.close()
+        self.gps_data = np.array(gps_rows, dtype=GPS_DATA_DTYPE)
+        self.gps_data['timestamp'] = self.calculate_utc_timestamps(
+            self.gps_data['timestamp'], np.array(gps_weeks, dtype=np.float64))
         # Split the mission command messages into missions
         # Get the timestamps from the messages and cluster them by getting groups that are less than 2 seconds apart
-        # The timestamps are already sorted
+        # The timestamps are already sorted, so each mission ends before the first message 2 seconds after its first one
+        command_timestamps = np.array(
+            [row[0] for row in mission_command_rows], dtype=np.int64)
         missions_in_log = []
-        current_mission = []
-        current_reference_timestamp = 0
-        for msg in mission_command_messages:
-            if len(current_mission) == 0:
-                current_mission.append(msg)
-                current_reference_timestamp = msg.TimeUS
-            elif msg.TimeUS - current_reference_timestamp < 2e6:
-                current_mission.append(msg)
-            else:
-                missions_in_log.append(current_mission)
-                current_mission = []
+        mission_start = 0
+        while mission_start < len(command_timestamps):
+            mission_end = int(np.searchsorted(
+                command_timestamps, command_timestamps[mission_start] + 2e6, side='left'))
+            missions_in_log.append(mission_command_rows[mission_start:mission_end])
+            mission_start = mission_end
         for mission in missions_in_log:
             # Only consider missions with more than one command, as a single command is merely a report we passed there
             if len(mission) > 1:
-                # Calculate the UTM coordinates for the first and last waypoints
-                first_waypoint = from_latlon(
-                    mission[0].Lat, mission[0].Lng)
-                last_waypoint = from_latlon(
-                    mission[-1].Lat, mission[-1].Lng)
-                # If they are more then 10 meters apart, add the first point to the end of the list
+                # Convert every waypoint to UTM coordinates at once
+                utm_easts, utm_norths = self.latlon_to_utm(
+                    np.array([waypoint[1] for waypoint in mission], dtype=np.float64),
+                    np.array([waypoint[2] for waypoint in mission], dtype=np.float64))
+                utm_easts, utm_norths = utm_easts.tolist(), utm_norths.tolist()
+                end_timestamp = mission[-1][0]
+                # If the first and last waypoints are more then 10 meters apart, add the first point to the end of the list
                 # with a timestamp 1 millisecond after the last one
-                if ((first_waypoint[0] - last_waypoint[0])**2 + (first_waypoint[1] - last_waypoint[1])**2)**0.5 > 10:
-                    mission.append(mission[0])
-                    mission[-1].TimeUS += 1e3
-                # Convert each point to UTM coordinates
-                waypoints_utm_coords = []
-                for waypoint in mission:
-                    utm_east, utm_north, _, _ = from_latlon(
-                        waypoint.Lat, waypoint.Lng)
-                    waypoints_utm_coords.append({
-                        'utm_east': utm_east,
-                        'utm_north': utm_north
-                    })
+                if ((utm_easts[0] - utm_easts[-1])**2 + (utm_norths[0] - utm_norths[-1])**2)**0.5 > 10:
+                    end_timestamp += 1e3
+                    utm_easts.append(utm_easts[0])
+                    utm_norths.append(utm_norths[0])
+                waypoints_utm_coords = [{'utm_east': utm_east, 'utm_north': utm_north}
+                                        for utm_east, utm_north in zip(utm_easts, utm_norths)]
                 self.missions_in_log.append({
-                    'start_timestamp': mission[0].TimeUS,
-                    'end_timestamp': mission[-1].TimeUS,
+                    'start_timestamp': mission[0][0],
+                    'end_timestamp': end_timestamp,
                     'waypoints': waypoints_utm_coords
                 })
 
     def reset_data(self) -> None:
         """Resets the data from the log file.
         """
-        self.gps_data = []
+        self.gps_data = np.empty(0, dtype=GPS_DATA_DTYPE)
         self.missions_in_log = []
 
     def get_utm_points_with_utc_timestamps(self) -> list:
@@ -134,15 +178,22 @@ class ArdupilotLogReader:
         Returns:
             list: the list of UTM points with UTC timestamps
         """
+        if len(self.gps_data) == 0:
+            return []
+        # Convert every GPS point to UTM coordinates at once, straight from the data columns
+        utm_easts, utm_norths = self.latlon_to_utm(
+            self.gps_data['latitude'], self.gps_data['longitude'])
         utm_data = []
-        for gps in self.gps_data:
-            utm_coords = from_latlon(gps['latitude'], gps['longitude'])
+        for utm_east, utm_north, altitude, timestamp, time_us in zip(utm_easts.tolist(), utm_norths.tolist(),
+                                                                     self.gps_data['altitude'].tolist(),
+                                                                     self.gps_data['timestamp'].tolist(),
+                                                                     self.gps_data['TimeUS'].tolist()):
             utm_data.append({
-                'utm_east': utm_coords[0],
-                'utm_north': utm_coords[1],
-                'altitude': gps['altitude'],
-                'timestamp': gps['timestamp'],
-                'TimeUS': gps['TimeUS']
+                'utm_east': utm_east,
+                'utm_north': utm_north,
+                'altitude': altitude,
+                'timestamp': timestamp,
+                'TimeUS': time_us
             })
         return utm_data
 
@@ -209,24 +260,24 @@ class ArdupilotLogReader:
         if main_mission is not None:
             gps_mission_match_indices = []
             last_matched_index = 0
+            # GPS coordinates as arrays, so the distances to each mission point are computed at once
+            gps_utm_easts = np.array([gps_point['utm_east'] for gps_point in log_gps_points], dtype=np.float64)
+            gps_utm_norths = np.array([gps_point['utm_north'] for gps_point in log_gps_points], dtype=np.float64)
             for mission_point in main_mission['waypoints']:
-                best_idx = -1
-                min_dist = float('inf')
-                
-                for i in range(last_matched_index, len(log_gps_points)):
-                    gps_point = log_gps_points[i]
-                    utm_east_diff = gps_point['utm_east'] - mission_point['utm_east']
-                    utm_north_diff = gps_point['utm_north'] - mission_point['utm_north']
-                    distance_diff = (utm_east_diff**2 + utm_north_diff**2)**0.5
-                    
-                    if distance_diff < min_dist:
-                        min_dist = distance_diff
-                        best_idx = i
-                    elif distance_diff > min_dist + 5: # Drone is moving away from the closest approach
-                        if min_dist < 15: # If it got reasonably close (within 15m)
-                            break
-                            
-                if best_idx != -1 and min_dist < 15:
+                if last_matched_index >= len(log_gps_points):
+                    continue
+                distances = np.hypot(gps_utm_easts[last_matched_index:] - mission_point['utm_east'],
+                                     gps_utm_norths[last_matched_index:] - mission_point['utm_north'])
+                # Closest distance found before each point
+                previous_min_distances = np.minimum.accumulate(distances)[:-1]
+                # Stop where the drone is moving away from the closest approach, if it got reasonably close (within 15m)
+                moving_away = (distances[1:] > previous_min_distances + 5) & (previous_min_distances < 15)
+                if moving_away.any():
+                    distances = distances[:np.argmax(moving_away) + 1]
+                best_idx = last_matched_index + int(np.argmin(distances))
+                min_dist = distances[best_idx - last_matched_index]
+
+                if min_dist < 15:
                     if not gps_mission_match_indices or best_idx > gps_mission_match_indices[-1]:
                         gps_mission_match_indices.append(best_idx)
                         last_matched_index = best_idx
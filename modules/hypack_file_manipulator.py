@@ -1,7 +1,16 @@
-from numpy import array
-from os import path
+from numpy import array, empty, dtype, float64, int64, nan, isnan, searchsorted, minimum, maximum, where, flatnonzero
+from os import path, replace, stat, remove
+from bisect import bisect_left, bisect_right
+from io import BytesIO
+from locale import getpreferredencoding
 from datetime import datetime, timedelta
-from utm import to_latlon, from_latlon
+from utm import latlon_to_zone_number
+from pyproj import Transformer
+
+
+# Layout of the GPS data read from the HSX file, one contiguous column per field
+HSX_GPS_DATA_DTYPE = dtype([("timestamp", float64), ("utm_east", float64), ("utm_north", float64),
+                            ("lat", float64), ("lon", float64), ("altitude", float64)])
 
 
 class HypackFileManipulator:
@@ -12,10 +21,18 @@ class HypackFileManipulator:
         self.input_raw_file_path = ""
         self.input_hsx_log_file_path = ""
         self.input_raw_log_file_path = ""
-        # list of dictionaries containing utm_east, utm_north and timestamp
-        self.gps_coordinates = []
+        # GPS points with timestamp, utm_east, utm_north, lat, lon and altitude
+        self.gps_coordinates = empty(0, dtype=HSX_GPS_DATA_DTYPE)
         # UTM zone we are working with
         self.utm_zone = None
+        # Transformers from each southern UTM zone used to latitude and longitude
+        self.latlon_transformers = dict()
+        # Byte offsets and timestamps of the lines of each data file split, by file path, with the file version they index
+        self.file_line_indices = dict()
+        # Date in the HSX file header, read once per file
+        self.hsx_file_date = ''
+        # Names of the files already in each log, by log file path
+        self.logged_file_names = dict()
 
 # region Setters
     def set_project_paths(self, hsx_file_path: str, raw_file_path: str, hsx_log_file_path: str, raw_log_file_path: str) -> None:
@@ -56,49 +73,49 @@ class HypackFileManipulator:
             return
         # Fill in a temporary dict with several data from different lines, but the same timestamp
         timestamp_dict = {}
+        # Last RAW position, which gives the UTM zone we are working with
+        last_raw_latlon = None
+        # Go through the file line by line, without loading it all in memory
         with open(self.input_hsx_file_path, 'r') as f:
-            lines = f.readlines()
-            for line in lines:
+            for line in f:
+                # Only the RAW, POS and TND lines are needed, so the others are not even split
+                if not line.startswith(('RAW ', 'POS ', 'TND ')):
+                    continue
                 line_split = line.split()
+                if line_split[0] == 'TND':
+                    # Keep the header date from this same pass, so the file is not read again for it
+                    if not self.hsx_file_date:
+                        self.hsx_file_date = line_split[2]
+                    continue
                 if line_split[0] == 'RAW' and len(line_split) >= 4:
-                    # Obtain UTM zone and altitude
-                    lat = float(line_split[4]) * 1e-4
-                    lon = float(line_split[5]) * 1e-4
-                    _, _, self.utm_zone, _ = from_latlon(lat, lon)
+                    # Obtain the position and altitude
+                    last_raw_latlon = (float(line_split[4]) * 1e-4, float(line_split[5]) * 1e-4)
                     altitude = float(line_split[6])
                     timestamp = float(line_split[2])
                     timestamp_dict[timestamp] = {
                         'altitude': altitude,
                     }
                 if line_split[0] == 'POS' and len(line_split) >= 4:
-                    # Obtain UTM coordinates
-                    utm_east = float(line_split[3])
-                    utm_north = float(line_split[4])
-                    lat, lon = to_latlon(
-                        easting=utm_east, northing=utm_north, zone_number=self.utm_zone, northern=False)
+                    # Obtain UTM coordinates, repeated timestamps keep only the last ones
                     timestamp = float(line_split[2])
-                    timestamp_dict[timestamp]['utm_east'] = utm_east
-                    timestamp_dict[timestamp]['utm_north'] = utm_north
-                    timestamp_dict[timestamp]["lat"] = lat
-                    timestamp_dict[timestamp]["lon"] = lon
-            f.close()
+                    timestamp_dict[timestamp]['utm_east'] = float(line_split[3])
+                    timestamp_dict[timestamp]['utm_north'] = float(line_split[4])
+        if last_raw_latlon is not None:
+            self.utm_zone = latlon_to_zone_number(*last_raw_latlon)
         # Fill the gps points
-        for key, item in timestamp_dict.items():
-            self.gps_coordinates.append(
-                {
-                    "timestamp": key,
-                    "utm_east": item["utm_east"],
-                    "utm_north": item["utm_north"],
-                    "lat": item["lat"],
-                    "lon": item["lon"],
-                    "altitude": item["altitude"],
-                }
-            )
+        self.gps_coordinates = array([(key, item["utm_east"], item["utm_north"], nan, nan, item["altitude"])
+                                      for key, item in timestamp_dict.items()], dtype=HSX_GPS_DATA_DTYPE)
+        # Convert to latlon only once per timestamp, for all the points at once
+        if len(self.gps_coordinates) > 0:
+            self.gps_coordinates['lon'], self.gps_coordinates['lat'] = self.get_latlon_transformer(self.utm_zone).transform(
+                self.gps_coordinates['utm_east'], self.gps_coordinates['utm_north'])
 
     def reset_data(self) -> None:
         """Reset the data from the HSX file
         """
-        self.gps_coordinates = []
+        self.gps_coordinates = empty(0, dtype=HSX_GPS_DATA_DTYPE)
+        self.file_line_indices = dict()
+        self.hsx_file_date = ''
 
     def get_date_from_file(self, file_path: str) -> str:
         """Gets the date in the file header
@@ -112,16 +129,72 @@ class HypackFileManipulator:
         date = ''
         if not path.exists(file_path):
             return date
+        # The date is in the header, so stop reading as soon as it is found
         with open(file_path, 'r') as f:
-            lines = f.readlines()
-            for line in lines:
-                line_split = line.split()
-                if line_split[0] == 'TND':
-                    date = line_split[2]
+            for line in f:
+                if line.startswith('TND '):
+                    date = line.split()[2]
                     break
-        f.close()
         return date
 
+    def get_file_line_index(self, file_path: str) -> tuple:
+        """Index the lines of a data file once, so the sections can be read without scanning it again
+
+        Args:
+            file_path (str): the file path
+
+        Returns:
+            tuple: the header size in bytes, the byte offset of each data line plus the file end and the timestamp of each data line (NaN if none)
+        """
+        # A file rewritten in place, as write_optimized_file can do, must be indexed again
+        file_stat = stat(file_path)
+        file_version = (file_stat.st_mtime_ns, file_stat.st_size)
+        if file_path in self.file_line_indices and self.file_line_indices[file_path][0] == file_version:
+            return self.file_line_indices[file_path][1]
+        header_size = None
+        line_offsets = []
+        line_timestamps = []
+        offset = 0
+        with open(file_path, 'rb') as f:
+            for line in f:
+                if header_size is None:
+                    offset += len(line)
+                    if line.startswith(b'EOH') and line.split()[0] == b'EOH':
+                        header_size = offset
+                    continue
+                line_offsets.append(offset)
+                offset += len(line)
+                # Only lines with a number in the timestamp position have a timestamp, the rest of the line is not needed
+                line_split = line.split(maxsplit=3)
+                timestamp = nan
+                if len(line_split) >= 3 and line_split[2].replace(b'.', b'', 1).isdigit():
+                    timestamp = float(line_split[2])
+                line_timestamps.append(timestamp)
+        # Without the end of header mark, the whole file is header
+        if header_size is None:
+            header_size = offset
+        line_offsets.append(offset)
+        self.file_line_indices[file_path] = (file_version, (header_size, array(line_offsets, dtype=int64),
+                                                           array(line_timestamps, dtype=float64)))
+        return self.file_line_indices[file_path][1]
+
+    def read_file_lines(self, file_path: str, start_offset: int, end_offset: int) -> list:
+        """Read the lines between two byte offsets of a file, as reading it in text mode would give them
+
+        Args:
+            file_path (str): the file path
+            start_offset (int): the offset of the first line
+            end_offset (int): the offset right after the last line
+
+        Returns:
+            list: the lines
+        """
+        with open(file_path, 'rb') as f:
+            f.seek(start_offset)
+            content = f.read(end_offset - start_offset)
+        encoding = getpreferredencoding(False)
+        return [line.decode(encoding).replace('\r\n', '\n') for line in BytesIO(content)]
+
     def get_data_file_section_content(self, initial_point_index: int, final_point_index: int, file_path: str) -> list:
         """Get the content of the file from the initial to the final point
 
@@ -133,47 +206,31 @@ class HypackFileManipulator:
         Returns:
             list: the content of the file from the initial to the final point
         """
-        initial_timestamp = self.gps_coordinates[initial_point_index]['timestamp']
-        final_timestamp = self.gps_coordinates[final_point_index]['timestamp']
-        base_timestamp = self.gps_coordinates[0]['timestamp']
-        with open(file_path, 'r') as f:
-            lines = f.readlines()
-            output_lines = []
-            header_section = True
-            data_section = False
-            for line in lines:
-                line_split = line.split()
-                if header_section:
-                    output_lines.append(line)
-                    if line_split[0] == 'EOH':
-                        header_section = False
-                    continue
-                elif not data_section:
-                    if len(line_split) < 3:
-                        continue
-                    timestamp_candidate = line_split[2]
-                    # Check if the candidate is a string
-                    if not timestamp_candidate.replace('.', '', 1).isdigit():
-                        continue
-                    if float(timestamp_candidate) == initial_timestamp:
-                        data_section = True
-                        output_lines.append(line)
-                else:
-                    if len(line_split) < 3:
-                        output_lines.append(line)
-                        continue
-                    timestamp_candidate = line_split[2]
-                    # Check if the candidate is a string, and if it is, add the line to the output
-                    if not timestamp_candidate.replace('.', '', 1).isdigit():
-                        output_lines.append(line)
-                        continue
-                    # If any number is found, it should be lower than the max timestamp diff
-                    timestamp_candidate = float(timestamp_candidate)
-                    if timestamp_candidate > final_timestamp:
-                        break
-                    if timestamp_candidate > initial_timestamp or timestamp_candidate < base_timestamp:
-                        output_lines.append(line)
-        f.close()
+        initial_timestamp = float(self.gps_coordinates['timestamp'][initial_point_index])
+        final_timestamp = float(self.gps_coordinates['timestamp'][final_point_index])
+        base_timestamp = float(self.gps_coordinates['timestamp'][0])
+        header_size, line_offsets, line_timestamps = self.get_file_line_index(
+            file_path=file_path)
+        output_lines = self.read_file_lines(
+            file_path=file_path, start_offset=0, end_offset=header_size)
+        # The data section starts at the first line with the initial timestamp
+        initial_lines = flatnonzero(line_timestamps == initial_timestamp)
+        if len(initial_lines) == 0:
+            return output_lines
+        section_start = initial_lines[0]
+        # And it goes until the first following line past the final timestamp
+        following_timestamps = line_timestamps[section_start + 1:]
+        past_final_lines = flatnonzero(following_timestamps > final_timestamp)
+        section_end = section_start + 1 + \
+            (past_final_lines[0] if len(past_final_lines) > 0 else len(following_timestamps))
+        # Keep the lines without timestamp, and the ones after the initial timestamp or before the base one
+        following_timestamps = following_timestamps[:section_end - section_start - 1]
+        keep_lines = [True] + (isnan(following_timestamps) | (following_timestamps > initial_timestamp) |
+                               (following_timestamps < base_timestamp)).tolist()
+        section_lines = self.read_file_lines(
+            file_path=file_path, start_offset=line_offsets[section_start], end_offset=line_offsets[section_end])
+        output_lines.extend(line for line, keep_line in zip(
+            section_lines, keep_lines) if keep_line)
         return output_lines
 # endregion
 # region FileSelectionAndGeneration
@@ -254,19 +311,18 @@ class HypackFileManipulator:
         if not path.exists(log_file_path):
             with open(log_file_path, 'w') as f:
                 f.write(file_name + '\n')
-            f.close()
+            self.logged_file_names[log_file_path] = {file_name}
             return
-        # Check if the file is already in the log
-        files_present_in_log = []
-        with open(log_file_path, 'r') as f:
-            files_present_in_log = f.readlines()
-        f.close()
-        if file_name+"\n" in files_present_in_log:
+        # Read the names in the log only once, then check if the file is already in it
+        if log_file_path not in self.logged_file_names:
+            with open(log_file_path, 'r') as f:
+                self.logged_file_names[log_file_path] = set(f.read().splitlines())
+        if file_name in self.logged_file_names[log_file_path]:
             return
         # Write the file name to the log
         with open(log_file_path, 'a') as f:
             f.write(file_name + '\n')
-        f.close()
+        self.logged_file_names[log_file_path].add(file_name)
 
 # endregion
 # region FileGPSOptimization
@@ -277,7 +333,10 @@ class HypackFileManipulator:
         Returns:
             datetime: the UTC timestamp
         """
-        hsx_date = self.get_date_from_file(self.input_hsx_file_path)
+        # The header date does not change for the same file, so it is only read once
+        if not self.hsx_file_date:
+            self.hsx_file_date = self.get_date_from_file(self.input_hsx_file_path)
+        hsx_date = self.hsx_file_date
         # Convert the hsx date to UTC seconds timestamp considering the time zone offset
         hsx_date_split = hsx_date.split('/')
         hsx_datetime_timezone = datetime(year=int(hsx_date_split[2]), month=int(hsx_date_split[0]), day=int(hsx_date_split[1]),
@@ -290,10 +349,27 @@ class HypackFileManipulator:
         Returns:
             list: the UTM points with the UTC timestamps
         """
-        hsx_time_utc = self.calculate_utc_timestamp()
-        return [{'utm_east': gps['utm_east'], 'utm_north': gps['utm_north'],
-                 'timestamp': (hsx_time_utc + timedelta(seconds=gps["timestamp"])).timestamp()}
-                for gps in self.gps_coordinates]
+        # Offset every timestamp by the file date at once
+        utc_timestamps = self.calculate_utc_timestamp().timestamp() + \
+            self.gps_coordinates['timestamp']
+        return [{'utm_east': utm_east, 'utm_north': utm_north, 'timestamp': timestamp}
+                for utm_east, utm_north, timestamp in zip(self.gps_coordinates['utm_east'].tolist(),
+                                                          self.gps_coordinates['utm_north'].tolist(),
+                                                          utc_timestamps.tolist())]
+
+    def get_latlon_transformer(self, zone_number: int) -> Transformer:
+        """Get the transformer from a southern hemisphere UTM zone to latitude and longitude, created once per zone
+
+        Args:
+            zone_number (int): the UTM zone number
+
+        Returns:
+            Transformer: the transformer, taking easts and norths and returning longitudes and latitudes
+        """
+        if zone_number not in self.latlon_transformers:
+            self.latlon_transformers[zone_number] = Transformer.from_crs(
+                f"EPSG:{32700 + zone_number}", "EPSG:4326", always_xy=True)
+        return self.latlon_transformers[zone_number]
 
     def optimize_gps_data(self, reference_gps_points: list) -> list:
         """Optimize the GPS data based on the reference GPS points and write to the output files
@@ -306,49 +382,46 @@ class HypackFileManipulator:
         """
         # Creating the optimized gps data based on timestamps interpolation between the reference gps points and the
         # hypack gps points, considering the timestamps of the hypack gps points
-        hsx_time_utc = self.calculate_utc_timestamp()
+        # The last reference point is never used, so at least two are needed
+        if len(reference_gps_points) < 2 or len(self.gps_coordinates) == 0:
+            return []
+        hypack_times = self.calculate_utc_timestamp().timestamp() + \
+            self.gps_coordinates['timestamp']
+        reference_times = array([ref_point['timestamp']
+                                 for ref_point in reference_gps_points[:-1]], dtype=float64)
+        reference_utm = array([[ref_point['utm_east'], ref_point['utm_north']]
+                               for ref_point in reference_gps_points[:-1]], dtype=float64)
+        # Find the reference points right before and right after every hypack point at once, as they are sorted in time
+        next_indices = searchsorted(reference_times, hypack_times)
+        has_previous = next_indices > 0
+        has_next = next_indices < len(reference_times)
+        next_indices = minimum(next_indices, len(reference_times) - 1)
+        previous_indices = maximum(next_indices - 1, 0)
+        # Points with the same timestamp as a reference point take it directly, the others are interpolated
+        exact_matches = has_next & (reference_times[next_indices] == hypack_times)
+        interpolated = has_previous & has_next & ~exact_matches
+        previous_times = reference_times[previous_indices]
+        weights = (hypack_times - previous_times) / \
+            where(interpolated, reference_times[next_indices] - previous_times, 1.0)
+        previous_utm = reference_utm[previous_indices]
+        scaled_points_utm = previous_utm + \
+            (reference_utm[next_indices] - previous_utm) * weights[:, None]
+        # Convert to latlon as well, for all the interpolated points at once
+        lons, lats = self.get_latlon_transformer(self.utm_zone).transform(
+            scaled_points_utm[interpolated, 0], scaled_points_utm[interpolated, 1])
+        interpolated_latlons = iter(zip(lats.tolist(), lons.tolist()))
+        # Add the points to the optimized data in the hypack order, the altitude always comes from Hypack
+        altitudes = self.gps_coordinates['altitude'].tolist()
+        original_hypack_times = self.gps_coordinates['timestamp'].tolist()
         optimized_gps_data = []
-        for hypack_point in self.gps_coordinates:
-            original_hypack_time = hypack_point["timestamp"]
-            hypack_time = (
-                hsx_time_utc + timedelta(seconds=original_hypack_time)).timestamp()
-            previous_ref_point = None
-            next_ref_point = None
-            for i, ref_point in enumerate(reference_gps_points):
-                # Substitute Hypack altitude in the reference point
-                ref_point['altitude'] = hypack_point['altitude']
-                if i == len(reference_gps_points) - 1:
-                    continue
-                ref_time = ref_point['timestamp']
-                if ref_time == hypack_time:
-                    optimized_gps_data.append(ref_point)
-                    break
-                elif hypack_time > ref_time:
-                    previous_ref_point = ref_point
-                    previous_ref_point["altitude"] = hypack_point["altitude"]
-                elif hypack_time < ref_time and previous_ref_point is not None:
-                    next_ref_point = ref_point
-                    next_ref_point["altitude"] = hypack_point["altitude"]
-                    break
-            if previous_ref_point is not None and next_ref_point is not None:
-                previous_time = previous_ref_point['timestamp']
-                previous_utm = array(
-                    [previous_ref_point['utm_east'], previous_ref_point['utm_north'], previous_ref_point['altitude']])
-                next_time = next_ref_point['timestamp']
-                next_utm = array(
-                    [next_ref_point['utm_east'], next_ref_point['utm_north'], next_ref_point['altitude']])
-
-                diff_time_hypack = abs(hypack_time - previous_time)
-                diff_time_ref = abs(next_time - previous_time)
-
-                scaled_point_utm = previous_utm + \
-                    (next_utm - previous_utm) * \
-                    (diff_time_hypack / diff_time_ref)
-                # Convert to latlon as well and add to optimized data
-                lat, lon = to_latlon(
-                    scaled_point_utm[0], scaled_point_utm[1], zone_number=self.utm_zone, northern=False)
+        for i in flatnonzero(exact_matches | interpolated).tolist():
+            if exact_matches[i]:
                 optimized_gps_data.append(
-                    {'utm_east': scaled_point_utm[0], 'utm_north': scaled_point_utm[1], 'altitude': scaled_point_utm[2], 'timestamp': original_hypack_time, 'lat': lat, 'lon': lon})
+                    dict(reference_gps_points[next_indices[i]], altitude=altitudes[i]))
+                continue
+            lat, lon = next(interpolated_latlons)
+            optimized_gps_data.append(
+                {'utm_east': float(scaled_points_utm[i, 0]), 'utm_north': float(scaled_points_utm[i, 1]), 'altitude': altitudes[i], 'timestamp': original_hypack_times[i], 'lat': lat, 'lon': lon})
         return optimized_gps_data
 
     def write_optimized_files(self, optimized_gps_data: list, output_files_base_path: str) -> bool:
@@ -390,41 +463,63 @@ class HypackFileManipulator:
         Returns:
             bool: if the operation was successful
         """
-        # Read the file and alter the lines that contain GPS information
+        # Sort the optimized data by timestamp once, so each line only looks at the data close to its timestamp
+        optimized_gps_data = sorted(
+            optimized_gps_data, key=lambda new_data: new_data['timestamp'])
+        optimized_timestamps = [new_data['timestamp']
+                                for new_data in optimized_gps_data]
+        # Get the zone we are at, from the file header
+        zone_number = 23
         with open(input_file_path, 'r') as f:
-            lines = f.readlines()
-            zone_number = 23
-            # Get the zone we are at
-            for i, line in enumerate(lines):
-                line_split = line.split()
-                if line_split[0] == "INI" and len(line_split) >= 3 and line_split[1] == "ZoneName=Zone":
-                    zone_number = int(line_split[-1].split('(')[0])
+            for line in f:
+                if line.startswith("INI "):
+                    line_split = line.split()
+                    if len(line_split) >= 3 and line_split[1] == "ZoneName=Zone":
+                        zone_number = int(line_split[-1].split('(')[0])
+                        break
+                if line.startswith("EOH"):
                     break
-            # Substitute the GPS data with the optimized data by searching the timestamp
-            for i, line in enumerate(lines):
-                line_split = line.split()
-                if line_split[0] == "POS" or line_split[0] == "RAW":
-                    timestamp = float(line_split[2])
-                    new_line = ''
-                    for new_data in optimized_gps_data:
-                        if abs(new_data['timestamp'] - timestamp) < 0.1:
-                            utm_east = new_data['utm_east']
-                            utm_north = new_data['utm_north']
-                            alt = new_data['altitude']
-                            if line_split[0] == "POS":
-                                new_line = f'POS {line_split[1]} {line_split[2]} {utm_east} {utm_north}\n'
-                            elif line_split[0] == "RAW":
-                                lat, lon = to_latlon(
-                                    utm_east, utm_north, zone_number, northern=False)
-                                new_line = f'RAW {line_split[1]} {line_split[2]} {line_split[3]} {lat*1e4} {lon*1e4} {alt} {line_split[7]}\n'
-                            break
-                    lines[i] = new_line
-        f.close()
-
-        with open(output_file_path, 'w') as f:
-            for line in lines:
-                f.write(line)
-        f.close()
-        return True
+        # Convert every optimized point to latlon at once, in the file zone
+        optimized_lons, optimized_lats = self.get_latlon_transformer(zone_number).transform(
+            [new_data['utm_east'] for new_data in optimized_gps_data],
+            [new_data['utm_north'] for new_data in optimized_gps_data])
+        # Stream the file to the output, altering the lines that contain GPS information
+        # The output is written aside first, so it can also replace the input file
+        temporary_output_file_path = output_file_path + ".tmp"
+        try:
+            with open(input_file_path, 'r') as f_in, open(temporary_output_file_path, 'w') as f_out:
+                for line in f_in:
+                    if line.startswith(("POS ", "RAW ")):
+                        line_split = line.split()
+                        # Substitute the GPS data with the optimized data by searching the timestamp
+                        timestamp = float(line_split[2])
+                        new_line = ''
+                        candidates_start = bisect_left(
+                            optimized_timestamps, timestamp - 0.2)
+                        candidates_end = bisect_right(
+                            optimized_timestamps, timestamp + 0.2)
+                        for match_index in range(candidates_start, candidates_end):
+                            new_data = optimized_gps_data[match_index]
+                            if abs(new_data['timestamp'] - timestamp) < 0.1:
+                                utm_east = new_data['utm_east']
+                                utm_north = new_data['utm_north']
+                                alt = new_data['altitude']
+                                if line_split[0] == "POS":
+                                    new_line = f'POS {line_split[1]} {line_split[2]} {utm_east} {utm_north}\n'
+                                elif line_split[0] == "RAW":
+                                    lat = optimized_lats[match_index]
+                                    lon = optimized_lons[match_index]
+                                    new_line = f'RAW {line_split[1]} {line_split[2]} {line_split[3]} {lat*1e4} {lon*1e4} {alt} {line_split[7]}\n'
+                                break
+                        line = new_line
+                    f_out.write(line)
+            replace(temporary_output_file_path, output_file_path)
+            return True
+        except Exception as e:
+            print(f'Error writing file {output_file_path}: {e}')
+            # Do not leave the partial output behind
+            if path.exists(temporary_output_file_path):
+                remove(temporary_output_file_path)
+            return False
 
 # endregion
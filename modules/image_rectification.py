@@ -1,5 +1,5 @@
-from numpy import ndarray, array, uint8, hstack
-from numpy import min as np_min
+from numpy import ndarray, asarray, array, uint8, int32, empty, concatenate, argmax, argsort, arange, tile, repeat, float32, column_stack, where, cumsum
+from cv2 import remap, INTER_LANCZOS4, BORDER_REPLICATE
 from PIL import Image
 from os import path, getenv
 
@@ -19,16 +19,25 @@ class ImageRectification:
         self.grid_width_px = int(self.grid_width_m / self.meters_pixel_ratio)
         self.grid_height_px = int(self.grid_height_m / self.meters_pixel_ratio)
         self.row_direction_meters_pixel_ratio = None
+        self.barrier_height_px = None
         self.collumn_width_px = int(
             self.collumn_width_m / self.meters_pixel_ratio)
         self.rectified_image = None
-        self.collumn_boxes = []
-
-    def snip_rectify_image(self, image: ndarray) -> ndarray:
+        # Detected boxes as [x1, y1, x2, y2] rows
+        self.collumn_boxes = empty((0, 4), dtype=int32)
+        self.barrier_box = None
+        # Sections to rectify, cached for the detected boxes as (image height, (boxes, types, widths))
+        self.rectification_sections = None
+        # Maps from the rectified image to the original one, cached as ((image height, grid height), (map_x, map_y))
+        self.rectification_maps = None
+
+    def snip_rectify_image(self, image: ndarray, out: ndarray = None, interpolation: int = INTER_LANCZOS4) -> ndarray:
         """Snips the region of interest and rectifies the content based on the detected boxes.
 
         Args:
             image (ndarray): input image
+            out (ndarray, optional): buffer to write the rectified image to, reused if it has the output shape. Defaults to None.
+            interpolation (int, optional): OpenCV interpolation flag, use INTER_NEAREST for class masks. Defaults to INTER_LANCZOS4.
 
         Raises:
             ValueError: We must set the collumn boxes before rectifying the image
@@ -36,91 +45,122 @@ class ImageRectification:
         Returns:
             ndarray: rectified image
         """
-        if not self.collumn_boxes:
+        if len(self.collumn_boxes) == 0:
             raise ValueError(
                 "Column boxes must be set before rectifying the image.")
 
+        # Where each rectified pixel comes from in the image, computed once for the detected boxes
+        map_x, map_y = self.get_rectification_maps(image_height=image.shape[0])
+
+        # Allocate the output image once, unless the given buffer already has the right shape
+        output_shape = map_x.shape + image.shape[2:]
+        if out is None or out.shape != output_shape or out.dtype != uint8:
+            out = empty(output_shape, dtype=uint8)
+
+        # Snip and stretch every section to its rectified size in a single pass over the image
+        self.rectified_image = remap(image, map_x, map_y, interpolation,
+                                     dst=out, borderMode=BORDER_REPLICATE)
+        return self.rectified_image
+
+    def snip_rectify_images(self, images: list, interpolations: list, outs: list = None) -> list:
+        """Snips and rectifies several images of the same size with the same sections.
+
+        Args:
+            images (list): input images, e.g. the original image and its class mask
+            interpolations (list): OpenCV interpolation flag for each image
+            outs (list, optional): buffers to write each rectified image to. Defaults to None.
+
+        Returns:
+            list: rectified images
+        """
+        if outs is None:
+            outs = [None] * len(images)
+        return [self.snip_rectify_image(image=image, out=out, interpolation=interpolation)
+                for image, interpolation, out in zip(images, interpolations, outs)]
+
+    def get_rectification_sections(self, image_height: int) -> tuple:
+        """Returns the boxes to snip, their types and rectified widths, computing them only once per detected boxes.
+
+        Args:
+            image_height (int): height of the images to rectify
+
+        Returns:
+            tuple: sorted boxes, their types and rectified widths
+        """
+        if self.rectification_sections is not None and self.rectification_sections[0] == image_height:
+            return self.rectification_sections[1]
+
         # Sort the boxes and the type they belong to so we can rectify the image
         boxes, types = self.sort_enhance_detected_boxes(self.collumn_boxes)
 
         # Define the highest and lowest points of the grid, and update the boxes to match them
-        grid_lowest_point = image.shape[0]
-        grid_highest_point = int(np_min(array([box[1] for box in boxes])))
-        for box in boxes:
-            box[1] = int(grid_highest_point)
-            box[3] = int(grid_lowest_point)
-
-        # For each box, rectify according to the desired dimension and add to the output image
-        # Resize the rows so we have the intended meters per pixel ratio in Y direction
-        if len(image.shape) == 2:
-            self.rectified_image = ndarray(
-                shape=(self.grid_height_px, 1), dtype=uint8)
-        else:
-            self.rectified_image = ndarray(
-                shape=(self.grid_height_px, 1, image.shape[2]), dtype=uint8)
-        for box, box_type in zip(boxes, types):
-            image_section = image[box[1]:box[3], box[0]:box[2]]
-            rectified_section = self.rectify_image_section(
-                image_section, box_type)
-            self.rectified_image = hstack(
-                (self.rectified_image, rectified_section))
-
-        # Remove the first column of the image, which is empty, and return
-        self.rectified_image = self.rectified_image[:, 1:]
-        return self.rectified_image
+        boxes[:, 1] = boxes[:, 1].min()
+        boxes[:, 3] = image_height
+        widths = where(types == 'grid', self.grid_width_px, self.collumn_width_px)
+
+        self.rectification_sections = (image_height, (boxes, types, widths))
+        return boxes, types, widths
+
+    def get_rectification_maps(self, image_height: int) -> tuple:
+        """Returns the maps from each rectified image pixel to the original image, computing them only once per detected boxes.
 
-    def sort_enhance_detected_boxes(self, collumn_boxes: list) -> tuple:
+        Args:
+            image_height (int): height of the images to rectify
+
+        Returns:
+            tuple: X and Y original image coordinates for each rectified image pixel
+        """
+        maps_key = (image_height, self.grid_height_px)
+        if self.rectification_maps is not None and self.rectification_maps[0] == maps_key:
+            return self.rectification_maps[1]
+
+        boxes, _, widths = self.get_rectification_sections(
+            image_height=image_height)
+        # Each section is stretched to its rectified width, sampling at the pixel centers as a resize does
+        # The start, scale and first output column of its section are repeated for every output column
+        section_starts = repeat(boxes[:, 0], widths)
+        section_scales = repeat((boxes[:, 2] - boxes[:, 0]) / widths, widths)
+        section_offsets = repeat(cumsum(widths) - widths, widths)
+        map_x_row = section_starts - 0.5 + \
+            (arange(len(section_starts)) - section_offsets + 0.5) * section_scales
+        # All the sections span the same rows, resized so we have the intended meters per pixel ratio in Y direction
+        top, bottom = boxes[0][1], boxes[0][3]
+        map_y_column = top - 0.5 + \
+            (arange(self.grid_height_px) + 0.5) * (bottom - top) / self.grid_height_px
+        map_x = tile(map_x_row.astype(float32), (self.grid_height_px, 1))
+        map_y = repeat(map_y_column.astype(float32)[:, None], len(map_x_row), axis=1)
+
+        self.rectification_maps = (maps_key, (map_x, map_y))
+        return map_x, map_y
+
+    def sort_enhance_detected_boxes(self, collumn_boxes: ndarray) -> tuple:
         """Sorts the detected boxes and their types. Creates grid boxes in between the collumn boxes.
 
         Args:
-            collumn_boxes (list): List of collumn boxes
+            collumn_boxes (ndarray): Collumn boxes, one per row
 
         Returns:
-            tuple: Sorted boxes and their types
+            tuple: Sorted boxes, one per row, and the array of their types
         """
         # Sort the collumn boxes by their x-coordinates
-        collumn_boxes = sorted(collumn_boxes, key=lambda x: x[0])
+        collumn_boxes = collumn_boxes[argsort(collumn_boxes[:, 0], kind="stable")]
         # Create grid boxes between the collumn boxes
-        grid_boxes = []
+        grid_boxes = [column_stack((collumn_boxes[:-1, 2], collumn_boxes[:-1, 1],
+                                    collumn_boxes[1:, 0], collumn_boxes[1:, 3]))]
         # If the grid box left point comes before the first collumn, add this as grid box first
-        if self.barrier_box[0] < collumn_boxes[0][0]:
-            grid_boxes.append(
-                [self.barrier_box[0], collumn_boxes[0][1], collumn_boxes[0][0], self.barrier_box[3]])
-        for i in range(len(collumn_boxes) - 1):
-            left_box = collumn_boxes[i]
-            right_box = collumn_boxes[i + 1]
-            # Create a grid box between the two collumn boxes
-            grid_box = [
-                int(left_box[2]), int(left_box[1]), int(right_box[0]), int(right_box[3])]
-            grid_boxes.append(grid_box)
+        if self.barrier_box[0] < collumn_boxes[0, 0]:
+            grid_boxes.insert(0, array(
+                [[self.barrier_box[0], collumn_boxes[0, 1], collumn_boxes[0, 0], self.barrier_box[3]]], dtype=int32))
         # If the grid box right point comes after the last collumn, add this as grid box last
-        if self.barrier_box[2] > collumn_boxes[-1][2]:
-            grid_boxes.append(
-                [collumn_boxes[-1][2], collumn_boxes[-1][1], self.barrier_box[2], self.barrier_box[3]])
+        if self.barrier_box[2] > collumn_boxes[-1, 2]:
+            grid_boxes.append(array(
+                [[collumn_boxes[-1, 2], collumn_boxes[-1, 1], self.barrier_box[2], self.barrier_box[3]]], dtype=int32))
+        grid_boxes = concatenate(grid_boxes)
         # Sort the boxes by their x-coordinates and assign the proper types in the same order
-        boxes = grid_boxes + collumn_boxes
-        types = ['grid'] * len(grid_boxes) + ['collumn'] * len(collumn_boxes)
-        sorted_boxes, sorted_types = zip(
-            *sorted(zip(boxes, types), key=lambda x: x[0][0]))
-        return list(sorted_boxes), list(sorted_types)
-
-    def rectify_image_section(self, image_section: ndarray, box_type: str) -> ndarray:
-        """Apply rectification to the image section based on the box type.
-
-        Args:
-            image_section (ndarray): input image section
-            box_type (str): type of the box ('grid' or 'collumn')
-
-        Returns:
-            ndarray: rectified image section
-        """
-        img = Image.fromarray(image_section)
-        # Desired new width from the box type, keeping the same height
-        new_width = self.grid_width_px if box_type == 'grid' else self.collumn_width_px
-        new_height = self.grid_height_px
-        resized_img = img.resize(
-            (new_width, new_height), Image.Resampling.LANCZOS)
-        return array(resized_img)
+        boxes = concatenate((grid_boxes, collumn_boxes))
+        types = array(['grid'] * len(grid_boxes) + ['collumn'] * len(collumn_boxes))
+        sorted_indices = argsort(boxes[:, 0], kind="stable")
+        return boxes[sorted_indices], types[sorted_indices]
 
     def get_rectified_image(self) -> ndarray:
         """Returns the rectified image.
@@ -139,13 +179,13 @@ class ImageRectification:
         Returns:
             ndarray: Original image section
         """
-        if not self.collumn_boxes:
+        if len(self.collumn_boxes) == 0:
             raise ValueError(
                 "Column boxes must be set before getting the original image section.")
 
-        collumn_boxes = sorted(self.collumn_boxes, key=lambda x: x[0])
-        section = image[collumn_boxes[0][1]:collumn_boxes[-1][3],
-                        collumn_boxes[0][0]:collumn_boxes[-1][2]]
+        collumn_boxes = self.collumn_boxes[argsort(self.collumn_boxes[:, 0], kind="stable")]
+        section = image[collumn_boxes[0, 1]:collumn_boxes[-1, 3],
+                        collumn_boxes[0, 0]:collumn_boxes[-1, 2]]
         return section
 
     def set_detected_boxes(self, collumn_boxes: list, barrier_boxes: list) -> None:
@@ -155,60 +195,61 @@ class ImageRectification:
             collumn_boxes (list): List of collumn boxes
             barrier_boxes (list): List of grid boxes
         """
-        # Get organized collumn boxes
-        collumn_boxes_int = []
-        for box in collumn_boxes:
-            collumn_boxes_int.append([int(p) for p in box])
-        self.collumn_boxes = self.filter_colliding_boxes(collumn_boxes_int)
-        # Set the barrier box as the biggest box
-        self.barrier_box = barrier_boxes[0]
-        barrier_box_area = (barrier_boxes[0][2] - barrier_boxes[0][0]) * \
-            (barrier_boxes[0][3] - barrier_boxes[0][1])
-        for box in barrier_boxes:
-            box_area = (box[2] - box[0]) * (box[3] - box[1])
-            if box_area > barrier_box_area:
-                barrier_box_area = box_area
-                self.barrier_box = box
-        self.barrier_box = [int(p) for p in self.barrier_box]
-
-    def filter_colliding_boxes(self, boxes: list) -> list:
+        # Get organized collumn boxes, truncated to pixels as one row per box
+        self.collumn_boxes = self.filter_colliding_boxes(
+            asarray(collumn_boxes).reshape(-1, 4).astype(int32))
+        self.rectification_sections = None
+        self.rectification_maps = None
+        # Set the barrier box as the biggest box, the first one if several have the same area
+        barrier_boxes = asarray(barrier_boxes).reshape(-1, 4)
+        barrier_boxes_areas = (barrier_boxes[:, 2] - barrier_boxes[:, 0]) * \
+            (barrier_boxes[:, 3] - barrier_boxes[:, 1])
+        self.barrier_box = barrier_boxes[argmax(barrier_boxes_areas)].astype(int32)
+        # The meters per pixel ratio in Y direction comes from the barrier box height, computed once per detected boxes
+        self.barrier_height_px = abs(int(self.barrier_box[3] - self.barrier_box[1]))
+        self.row_direction_meters_pixel_ratio = self.grid_height_m / self.barrier_height_px
+
+    def filter_colliding_boxes(self, boxes: ndarray) -> ndarray:
         """
-        Filters a list of bounding boxes, adding only the biggest one in each collision bin.
+        Filters the bounding boxes, adding only the biggest one in each group of colliding boxes.
 
         Args:
-            boxes (list): A list of bounding boxes, where each box is represented as [x1, y1, x2, y2].
+            boxes (ndarray): The bounding boxes, where each row is a box represented as [x1, y1, x2, y2].
 
         Returns:
-            A list of non-colliding bounding boxes.
+            The non-colliding bounding boxes, one per row.
         """
-        # Split the boxes in bins if they collide
-        boxes_bins = []
-        added_boxes = []
-        for i, box1 in enumerate(boxes):
-            if i in added_boxes:
-                continue
-            is_colliding = False
-            boxes_bins.append([box1])
-            for j, box2 in enumerate(boxes):
-                if j > i:
-                    is_colliding = not (
-                        box1[2] < box2[0] or box1[0] > box2[2] or box1[3] < box2[1] or box1[1] > box2[3])
-                    if is_colliding:
-                        boxes_bins[-1].append(box2)
-                        added_boxes.append(j)
-
-        # Filter the boxes, keeping only the non-colliding and the ones
-        # with the biggest area if they collide
-        non_colliding_boxes = []
-        for box_bin in boxes_bins:
-            if len(box_bin) == 1:
-                non_colliding_boxes.append(box_bin[0])
-            else:
-                # Find the box with the biggest area to add
-                biggest_box = max(box_bin, key=lambda box: (
-                    box[2] - box[0]) * (box[3] - box[1]))
-                non_colliding_boxes.append(biggest_box)
-        return non_colliding_boxes
+        if len(boxes) == 0:
+            return boxes
+        boxes_list = boxes.tolist()
+        # Group the colliding boxes, boxes colliding through a chain of others end up in the same group
+        groups = list(range(len(boxes_list)))
+
+        def find_group(i: int) -> int:
+            while groups[i] != i:
+                groups[i] = groups[groups[i]]
+                i = groups[i]
+            return i
+
+        # Sweep the boxes by their left side, only testing the ones that did not end before it in X
+        open_boxes = []
+        for i in argsort(boxes[:, 0], kind="stable").tolist():
+            x1, y1, _, y2 = boxes_list[i]
+            # Boxes ending before this one starts cannot collide with it or with any of the following ones
+            open_boxes = [j for j in open_boxes if boxes_list[j][2] >= x1]
+            for j in open_boxes:
+                if not (boxes_list[j][3] < y1 or boxes_list[j][1] > y2):
+                    groups[find_group(j)] = find_group(i)
+            open_boxes.append(i)
+
+        # Keep only the box with the biggest area in each group, the first one if several have the same area
+        areas = ((boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1])).tolist()
+        biggest_in_group = dict()
+        for i in range(len(boxes_list)):
+            group = find_group(i)
+            if group not in biggest_in_group or areas[i] > areas[biggest_in_group[group]]:
+                biggest_in_group[group] = i
+        return boxes[list(biggest_in_group.values())]
 
     def get_meters_pixel_ratio(self) -> dict:
         """Returns the meters per pixel ratio for both directions.
@@ -218,8 +259,6 @@ class ImageRectification:
         """
         if self.barrier_box is None:
             raise ValueError("Barrier box is not set.")
-        self.grid_height_px = abs(self.barrier_box[3] - self.barrier_box[1])
-        self.row_direction_meters_pixel_ratio = self.grid_height_m / self.grid_height_px
         return {
             "x_res": self.meters_pixel_ratio,
             "y_res": self.row_direction_meters_pixel_ratio
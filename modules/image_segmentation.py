@@ -1,20 +1,26 @@
-from os import path, getenv
+from os import path, getenv, replace
 from typing import Tuple
 from PIL import Image
 from numpy import ndarray, arange, array, zeros, zeros_like, float32, uint8
 from numpy import max as np_max
-from torch import cuda
+from torch import cuda, inference_mode
+from cv2 import resize, INTER_AREA
 
 
 class ImageSegmentation:
-    def __init__(self, model_path: str):
+    def __init__(self, model_path: str, backend: str = "pytorch", imgsz: int = 640):
         """This class is used to perform image segmentation using a YOLOv11 model.
 
         Args:
             model_path (str): path to the trained YOLOv11 model
+            backend (str, optional): inference backend, one of 'pytorch', 'onnx' or 'engine' (TensorRT). Defaults to 'pytorch'.
+            imgsz (int, optional): square input size of the model, multiple of 32. Defaults to 640.
         """
         from ultralytics import YOLO
-        self.model = YOLO(model_path)
+        # Input size the image is resized to before the prediction
+        self.imgsz = imgsz
+        self.model = YOLO(self.get_backend_model_path(
+            model_path=model_path, backend=backend), task="segment")
         # Output detections info
         self.detections_by_class_dict = dict()
         # Global mask for the image, with the class codes
@@ -27,6 +33,34 @@ class ImageSegmentation:
         # Colormap for the classes
         self.classes_colormap = None
 
+    def get_backend_model_path(self, model_path: str, backend: str) -> str:
+        """Returns the model path for the inference backend, exporting the trained model the first time it is needed.
+
+        Args:
+            model_path (str): path to the trained YOLOv11 model
+            backend (str): inference backend, one of 'pytorch', 'onnx' or 'engine' (TensorRT)
+
+        Raises:
+            ValueError: If the backend is not supported
+
+        Returns:
+            str: path to the model to load
+        """
+        if backend not in ("pytorch", "onnx", "engine"):
+            raise ValueError(f"Unsupported inference backend: {backend}")
+        if backend == "pytorch":
+            return model_path
+        # TensorRT engines can only be built and run on NVIDIA GPUs, use ONNX Runtime otherwise
+        if backend == "engine" and not cuda.is_available():
+            backend = "onnx"
+        # The input size and precision are fixed at export time, so they are part of the exported file name
+        half = backend == "engine"
+        exported_model_path = f"{path.splitext(model_path)[0]}_{self.imgsz}_{'fp16' if half else 'fp32'}.{backend}"
+        if not path.exists(exported_model_path):
+            from ultralytics import YOLO
+            replace(YOLO(model_path).export(format=backend, imgsz=self.imgsz, half=half), exported_model_path)
+        return exported_model_path
+
     def segment_classes(self, image: ndarray) -> bool:
         """Predicts the segmentation masks, classes and boxes for the given image.
 
@@ -39,23 +73,25 @@ class ImageSegmentation:
         # Start the masked image with the original one
         self.masked_original_image = image.copy()
 
-        # Load the image to get the dimensions
+        # Get the dimensions and bring the image to the model input size before anything else handles it
+        image_height, image_width = image.shape[:2]
+        if image_width != self.imgsz or image_height != self.imgsz:
+            image = resize(image, (self.imgsz, self.imgsz),
+                           interpolation=INTER_AREA)
+        # YOLO takes arrays as BGR, so the RGB image goes in PIL format
         resized_image_pil = Image.fromarray(image)
-        image_width, image_height = resized_image_pil.size
-        # If image is not 640x640, resize it
-        if image_width != 640 or image_height != 640:
-            resized_image_pil = resized_image_pil.resize(
-                (640, 640), Image.Resampling.LANCZOS)
 
         # Initialize the global mask
         self.image_detections_mask = zeros(
             (image_height, image_width), dtype=uint8)
 
-        # Predict detections in the image
+        # Predict detections in the image, in half precision when running on the GPU
         device = "cuda" if cuda.is_available() else "cpu"
-        results = self.model.predict(source=resized_image_pil, show=False, save=False, conf=0.2,
-                                     line_width=1, save_crop=False, save_txt=False,
-                                     show_labels=False, show_conf=False, device=device)
+        with inference_mode():
+            results = self.model.predict(source=resized_image_pil, show=False, save=False, conf=0.2,
+                                         line_width=1, save_crop=False, save_txt=False,
+                                         show_labels=False, show_conf=False, device=device,
+                                         half=device == "cuda", imgsz=self.imgsz)
 
         # Check if the model has detected any masks or boxes
         if results[0].masks is None or results[0].boxes is None:
@@ -72,12 +108,17 @@ class ImageSegmentation:
 
         # Iterate through the results and store the masks, boxes and confidences
         for result in results:
-            for i in range(len(result.boxes)):
+            # Bring every detection of this result to the host at once, instead of one transfer per detection
+            result_boxes = result.boxes.xyxy.cpu().tolist()
+            result_confs = result.boxes.conf.cpu().tolist()
+            result_cls_ids = result.boxes.cls.cpu().int().tolist()
+            result_masks = result.masks.data.cpu().numpy()
+            for i in range(len(result_boxes)):
                 # Extract info
-                box = result.boxes[i].xyxy[0].tolist()
-                conf = result.boxes[i].conf[0].item()
-                mask = result.masks.data[i].cpu().numpy()
-                cls_id = int(result.boxes[i].cls[0].item())
+                box = result_boxes[i]
+                conf = result_confs[i]
+                mask = result_masks[i]
+                cls_id = result_cls_ids[i]
                 class_name = result.names[cls_id]
 
                 # Depending on the class and confidence, avoid storing the detection:
@@ -89,10 +130,10 @@ class ImageSegmentation:
                 mask = array(Image.fromarray(mask).resize(
                     (image_width, image_height), Image.Resampling.NEAREST))
                 # Resize the box to the original image size
-                box[0] = int(box[0] * image_width / 640)
-                box[1] = int(box[1] * image_height / 640)
-                box[2] = int(box[2] * image_width / 640)
-                box[3] = int(box[3] * image_height / 640)
+                box[0] = int(box[0] * image_width / self.imgsz)
+                box[1] = int(box[1] * image_height / self.imgsz)
+                box[2] = int(box[2] * image_width / self.imgsz)
+                box[3] = int(box[3] * image_height / self.imgsz)
 
                 # Store in the class dictionary
                 if class_name not in self.detections_by_class_dict:
@@ -161,14 +202,10 @@ class ImageSegmentation:
         """
         mask_region = mask.astype(bool)
         class_code = self.image_class_mask_codes[class_name]
-        for i in range(mask.shape[0]):
-            for j in range(mask.shape[1]):
-                # If the pixel is already marked as sedimento or macrofita, skip it
-                if self.image_detections_mask[i, j] == self.image_class_mask_codes["sedimento"] or self.image_detections_mask[i, j] == self.image_class_mask_codes["macrofita"]:
-                    continue
-                # If the pixel is part of the mask, set it to the class code
-                if mask_region[i, j]:
-                    self.image_detections_mask[i, j] = class_code
+        # Pixels already marked as sedimento or macrofita are kept, the others in the mask get the class code
+        kept_region = (self.image_detections_mask == self.image_class_mask_codes["sedimento"]) | \
+            (self.image_detections_mask == self.image_class_mask_codes["macrofita"])
+        self.image_detections_mask[mask_region & ~kept_region] = class_code
 
     def get_detections_by_class(self, class_name: str) -> Tuple[list, list]:
         """Returns the detections for a specific class.
@@ -1,9 +1,10 @@
 from PIL import Image
-from numpy import array, ndarray, float32
+from numpy import array, ndarray, float32, float64, nonzero, column_stack
 from numpy import mean as np_mean, dot as np_dot, cov as np_cov, argmin as np_argmin
 from numpy import arccos as np_arccos, pi as np_pi, min as np_min, max as np_max
 from numpy.linalg import eigh, norm
 import open3d as o3d
+from torch import cuda, inference_mode, autocast, float16
 from typing import Tuple
 from os import path
 from json import load as json_load
@@ -11,13 +12,13 @@ from modules.path_tool import get_file_placement_path
 
 
 class MetricsEstimation:
-    def __init__(self, model_local_path: str, m_per_pixel: dict, class_ids: dict) -> None:
+    def __init__(self, model_local_path: str, m_per_pixel: dict = None, class_ids: dict = None) -> None:
         """This class is used to estimate the volume of objects in an image using a depth estimation model.
 
         Args:
             model_local_path (str): path of the depth estimation model
-            m_per_pixel (dict): meters per pixel ratio for x and y directions
-            class_ids (dict): Dict of class IDs the model can detect in the form of 'name': code(int)
+            m_per_pixel (dict, optional): meters per pixel ratio for x and y directions. Defaults to None.
+            class_ids (dict, optional): Dict of class IDs the model can detect in the form of 'name': code(int). Defaults to None.
         """
         from transformers import DepthAnythingForDepthEstimation, AutoImageProcessor, DepthAnythingConfig, pipeline
         config_relative_path = path.join(model_local_path, "config.json")
@@ -30,15 +31,38 @@ class MetricsEstimation:
         config = DepthAnythingConfig.from_dict(config_data)
         model = DepthAnythingForDepthEstimation.from_pretrained(
             model_local_path, config=config, ignore_mismatched_sizes=True)
+        model.eval()
         processor = AutoImageProcessor.from_pretrained(model_local_path)
         # Loading the pipeline from the proper model configs and image processor, and other class variables
+        self.use_cuda = cuda.is_available()
         self.pipe = pipeline(task="depth-estimation",
-                             model=model, image_processor=processor)
+                             model=model, image_processor=processor, device=0 if self.use_cuda else -1)
         self.m_per_pixel = m_per_pixel
         self.class_ids = class_ids
         # Grid plane model to use if no grid is detected in the section
         self.grid_plane_model = None
 
+    def set_m_per_pixel(self, m_per_pixel: dict) -> None:
+        """Sets the meters per pixel ratio of the image to estimate the metrics for.
+
+        Args:
+            m_per_pixel (dict): meters per pixel ratio for x and y directions
+        """
+        self.m_per_pixel = m_per_pixel
+
+    def set_class_ids(self, class_ids: dict) -> None:
+        """Sets the class IDs the segmentation model can detect.
+
+        Args:
+            class_ids (dict): Dict of class IDs the model can detect in the form of 'name': code(int)
+        """
+        self.class_ids = class_ids
+
+    def reset_grid_plane_model(self) -> None:
+        """Resets the grid plane model, so a new image does not use the one from the previous image.
+        """
+        self.grid_plane_model = None
+
     def estimate_blocking_area_volume(self, image: ndarray, box: list, mask: ndarray, class_name: str, debug: bool = False) -> Tuple:
         """Estimates the volume of objects in the image.
 
@@ -52,22 +76,84 @@ class MetricsEstimation:
         Returns:
             Tuple: estimated area and volume of the object
         """
-        # Enhance the box by h% in height and w% in width, making sure it does not go outside the image boundaries
+        return self.estimate_blocking_areas_volumes(
+            image=image, boxes=[box], mask=mask, class_names=[class_name], debug=debug)[0]
+
+    def estimate_blocking_areas_volumes(self, image: ndarray, boxes: list, mask: ndarray, class_names: list, debug: bool = False) -> list:
+        """Estimates the volume of several objects in the image.
+        The depth model runs for all the boxes in a single pipeline call, and the point cloud processing follows in the boxes order.
+
+        Args:
+            image (ndarray): original image
+            boxes (list): bounding boxes of the objects in the image
+            mask (ndarray): binary mask of the region with grid, collumn and obstruction indices
+            class_names (list): name of the class to estimate the volume for, for each box
+            debug (bool, optional): if True, shows the debug point clouds. Defaults to False.
+
+        Returns:
+            list: estimated area and volume tuple for each box
+        """
+        # Get the bounding box sections of the image and the mask
+        image_bboxes, mask_bboxes = [], []
+        for box in boxes:
+            self.enhance_box(box=box, image_shape=image.shape)
+            image_bboxes.append(image[box[1]:box[3], box[0]:box[2]])
+            mask_bboxes.append(mask[box[1]:box[3], box[0]:box[2]])
+
+        # Run pipeline in the bounding box image sections to get depth images in pixels
+        depth_image_bboxes = self.estimate_depth_images(image_bboxes=image_bboxes)
+
+        # The grid plane model is carried from one box to the next, so this part must keep the boxes order
+        areas_volumes = []
+        for image_bbox, mask_bbox, depth_image_bbox, class_name in zip(image_bboxes, mask_bboxes, depth_image_bboxes, class_names):
+            areas_volumes.append(self.estimate_area_volume_from_depth(
+                image_bbox=image_bbox, mask_bbox=mask_bbox, depth_image_bbox=depth_image_bbox,
+                class_name=class_name, debug=debug))
+        return areas_volumes
+
+    def enhance_box(self, box: list, image_shape: tuple) -> None:
+        """Enhances the box in place by 10% in height and width, making sure it does not go outside the image boundaries
+
+        Args:
+            box (list): bounding box of the object in the image
+            image_shape (tuple): shape of the image the box belongs to
+        """
         h, w = 0.1, 0.1
         box[0] = max(0, int(box[0] - w * (box[2] - box[0])))
         box[1] = max(0, int(box[1] - h * (box[3] - box[1])))
-        box[2] = min(image.shape[1], int(box[2] + w * (box[2] - box[0])))
-        box[3] = min(image.shape[0], int(box[3] + h * (box[3] - box[1])))
+        box[2] = min(image_shape[1], int(box[2] + w * (box[2] - box[0])))
+        box[3] = min(image_shape[0], int(box[3] + h * (box[3] - box[1])))
 
-        # Get the bounding box section of the image and the mask
-        image_bbox = image[box[1]:box[3], box[0]:box[2]]
-        mask_bbox = mask[box[1]:box[3], box[0]:box[2]]
+    def estimate_depth_images(self, image_bboxes: list) -> list:
+        """Runs the depth estimation model in several image sections with a single pipeline call
 
-        # Run pipeline in the bounding box image section to get depth image in pixels
-        image_bbox_pil = Image.fromarray(image_bbox)
-        depth_image_bbox_pil = self.pipe(image_bbox_pil)["depth"]
-        depth_image_bbox = array(depth_image_bbox_pil)
+        Args:
+            image_bboxes (list): the image sections
 
+        Returns:
+            list: the depth image in pixels of each section
+        """
+        if not image_bboxes:
+            return []
+        image_bboxes_pil = [Image.fromarray(image_bbox) for image_bbox in image_bboxes]
+        # No autograd bookkeeping, and half precision when running on the GPU
+        with inference_mode(), autocast("cuda", dtype=float16, enabled=self.use_cuda):
+            depth_outputs = self.pipe(image_bboxes_pil)
+        return [array(depth_output["depth"]) for depth_output in depth_outputs]
+
+    def estimate_area_volume_from_depth(self, image_bbox: ndarray, mask_bbox: ndarray, depth_image_bbox: ndarray, class_name: str, debug: bool = False) -> Tuple:
+        """Estimates the area and volume of an object from its image section depth
+
+        Args:
+            image_bbox (ndarray): the image section
+            mask_bbox (ndarray): the mask section with grid, collumn and obstruction indices
+            depth_image_bbox (ndarray): the depth image of the section
+            class_name (str): name of the class to estimate the volume for
+            debug (bool, optional): if True, shows the debug point clouds. Defaults to False.
+
+        Returns:
+            Tuple: estimated area and volume of the object
+        """
         # Split the depth image into grid and class_name point clouds
         grid_ptc, class_ptc = self.split_class_grid_ptcs(
             mask=mask_bbox, depth_image=depth_image_bbox,
@@ -216,28 +302,24 @@ class MetricsEstimation:
 
         class_id = self.class_ids[class_name]
         barragem_id = self.class_ids["barragem"]
-        class_points, class_colors = [], []
-        grid_points, grid_colors = [], []
-        # Search the mask and add the proper points for barragem or class
-        for row in range(depth_image.shape[0]):
-            for col in range(depth_image.shape[1]):
-                if mask[row, col] == class_id:
-                    class_points.append([col, row, depth_image[row, col]])
-                    class_colors.append(
-                        rgb_image[row, col].astype(float32)/255)
-                elif mask[row, col] == barragem_id:
-                    grid_points.append([col, row, depth_image[row, col]])
-                    grid_colors.append(
-                        rgb_image[row, col].astype(float32)/255)
+        # Search the mask and get the proper points for barragem or class, in row-major order
+        class_rows, class_cols = nonzero(mask == class_id)
+        class_points = column_stack(
+            [class_cols, class_rows, depth_image[class_rows, class_cols]]).astype(float64)
+        class_colors = rgb_image[class_rows, class_cols].astype(float32)/255
+        grid_rows, grid_cols = nonzero(mask == barragem_id)
+        grid_points = column_stack(
+            [grid_cols, grid_rows, depth_image[grid_rows, grid_cols]]).astype(float64)
+        grid_colors = rgb_image[grid_rows, grid_cols].astype(float32)/255
 
         # Create point clouds for the grid and the class
         class_ptc = o3d.geometry.PointCloud()
-        class_ptc.points = o3d.utility.Vector3dVector(array(class_points))
-        class_ptc.colors = o3d.utility.Vector3dVector(array(class_colors))
+        class_ptc.points = o3d.utility.Vector3dVector(class_points)
+        class_ptc.colors = o3d.utility.Vector3dVector(class_colors.astype(float64))
         grid_ptc = o3d.geometry.PointCloud()
         if len(grid_points) > 0:  # Sometimes the grid is not detected
-            grid_ptc.points = o3d.utility.Vector3dVector(array(grid_points))
-            grid_ptc.colors = o3d.utility.Vector3dVector(array(grid_colors))
+            grid_ptc.points = o3d.utility.Vector3dVector(grid_points)
+            grid_ptc.colors = o3d.utility.Vector3dVector(grid_colors.astype(float64))
         return grid_ptc, class_ptc
 
     def calculate_detection_volume(self, ptc: o3d.geometry.PointCloud, plane_model: list) -> float:
@@ -38,6 +38,8 @@ class ReportGenerator:
             str: The message with the process result.
         """
         try:
+            # Start from an empty story, so the content of previous reports is not carried over
+            self.story = []
             # Adding the header information
             self.add_title(
                 "Relatório de análises métricas de imagem do sonar Apex")
@@ -58,12 +60,13 @@ class ReportGenerator:
             self.add_subtitle("Valores de métricas por detecção", level=1)
             metrics = self.data.get("metrics", ())
             metrics_per_detection = metrics[0]
-            for i, detection in enumerate(metrics_per_detection):
+            for i, (detection_class, area, volume) in enumerate(zip(metrics_per_detection["class"].tolist(),
+                                                                    metrics_per_detection["area"].tolist(),
+                                                                    metrics_per_detection["volume"].tolist())):
                 self.add_item(f"Número: {i}")
-                self.add_item(
-                    f"Tipo de detecção: {detection.get('class', 'N/A')}")
-                self.add_item(f"Área: {detection.get('area', 'N/A')}")
-                self.add_item(f"Volume: {detection.get('volume', 'N/A')}")
+                self.add_item(f"Tipo de detecção: {detection_class}")
+                self.add_item(f"Área: {area}")
+                self.add_item(f"Volume: {volume}")
                 self.story.append(Spacer(1, 0.2 * inch))
             self.add_subtitle("Valores de métricas por classe", level=1)
             metrics_per_class = metrics[1]
@@ -77,6 +80,9 @@ class ReportGenerator:
             return f"Report saved to {self.output_path}"
         except Exception as e:
             return f"Error generating report: {str(e)}"
+        finally:
+            # Release the flowables and their image buffers once the file is written
+            self.story = []
 
     def add_title(self, text: str) -> None:
         """Add a title to the report.
@@ -147,6 +153,7 @@ class ReportGenerator:
         """
         buffer = QBuffer()
         buffer.open(QIODevice.WriteOnly)
-        pixmap.save(buffer, "PNG")
+        # Lighter PNG compression, the image is only decoded again by the report builder
+        pixmap.save(buffer, "PNG", 80)
         data = buffer.data()
         return BytesIO(data)
@@ -1,10 +1,10 @@
 import open3d as o3d
-from numpy import array, asarray, uint8
-from numpy import min as np_min, max as np_max, abs as np_abs
+from numpy import asarray, uint8, arange, minimum, zeros, intp, ndarray, diff, concatenate, empty, multiply
+from numpy import abs as np_abs
 from numpy import median as np_median, std as np_std, sum as np_sum
 from argparse import ArgumentParser
 from os import path
-from copy import deepcopy
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pyvista import PolyData
 from typing import Generator
 
@@ -16,6 +16,13 @@ class SaescPipeline:
         self.merged_cloud = o3d.geometry.PointCloud()
         self.output_path = ""
         self.sonar_depth = 0.5  # [m]
+        self.drone_voxel_size = 0.02  # [m]
+        # Colormap used to paint the sonar clouds by depth [jet, seismic, viridis]
+        self.sonar_colormap_name = "jet"
+        # RGB lookup tables of the colormaps used to paint the clouds, built on first use
+        self.colormap_luts = dict()
+        # Clouds loaded and processed at the same time, few since each one holds a whole raw cloud in memory
+        self.max_loading_workers = 2
 
     def set_input_data(self, input_clouds_paths: list, input_clouds_types: list, sea_level_refs: list, preprocess_flags: list) -> None:
         """Sets the input data for the pipeline.
@@ -69,9 +76,6 @@ class SaescPipeline:
         Returns:
             o3d.geometry.PointCloud: processed sonar point cloud
         """
-        import matplotlib
-        matplotlib.use('Qt5Agg')
-        from matplotlib import colormaps
         # Voxelgrid
         cloud = cloud.voxel_down_sample(voxel_size=0.3)
         if preprocess_flag:
@@ -80,23 +84,43 @@ class SaescPipeline:
                                                         std_ratio=1)
             # Remove spikes in the Z axis
             cloud = self.remove_spikes(pcd=cloud, radius=2, deviation=1.5)
-        # Correct sea level
-        points = array(cloud.points)
-        points[:, 2] += sea_level_ref - self.sonar_depth
-        cloud.points = o3d.utility.Vector3dVector(points)
-        # Calculate the normals, flipping towards positive z
+        # Correct sea level, translating the cloud in place
+        cloud.translate((0, 0, sea_level_ref - self.sonar_depth))
+        # Calculate the normals, flipping towards positive z in place
         cloud.estimate_normals(
             search_param=o3d.geometry.KDTreeSearchParamHybrid(radius=0.1, max_nn=30))
-        cloud.normals = o3d.utility.Vector3dVector(
-            array(cloud.normals) * array([1, 1, -1]))
+        asarray(cloud.normals)[:, 2] *= -1
         # Apply colormap intensity to the point cloud according to the depth in z
-        z_values = np_abs(array(cloud.points)[:, 2])
-        intensity = (z_values - np_min(z_values)) / \
-            (np_max(z_values) - np_min(z_values))
-        colormap_name = "jet"  # [jet, seismic, viridis]
-        cmap = colormaps.get_cmap(colormap_name)
-        cloud.colors = o3d.utility.Vector3dVector(cmap(intensity)[:, :3])
-        return deepcopy(cloud)
+        colormap_lut = self.get_colormap_lut(self.sonar_colormap_name)
+        z_values = np_abs(asarray(cloud.points)[:, 2])
+        z_min = z_values.min()
+        z_range = z_values.max() - z_min
+        # Index the lookup table the same way the colormap does, normalizing the depths in place
+        if z_range > 0:
+            z_values -= z_min
+            z_values *= len(colormap_lut) / z_range
+            lut_indices = minimum(z_values.astype(intp), len(colormap_lut) - 1)
+        else:
+            lut_indices = zeros(len(z_values), dtype=intp)
+        cloud.colors = o3d.utility.Vector3dVector(colormap_lut[lut_indices])
+        return cloud
+
+    def get_colormap_lut(self, colormap_name: str) -> ndarray:
+        """Returns the RGB lookup table of a matplotlib colormap, built only once per colormap.
+
+        Args:
+            colormap_name (str): name of the colormap
+
+        Returns:
+            ndarray: RGB color for each colormap entry
+        """
+        if colormap_name not in self.colormap_luts:
+            import matplotlib
+            matplotlib.use('Qt5Agg')
+            from matplotlib import colormaps
+            cmap = colormaps.get_cmap(colormap_name)
+            self.colormap_luts[colormap_name] = cmap(arange(cmap.N))[:, :3]
+        return self.colormap_luts[colormap_name]
 
     def process_drone_cloud(self, cloud: o3d.geometry.PointCloud, sea_level_ref: float) -> o3d.geometry.PointCloud:
         """Processes the drone point cloud by removing the noise and the ground plane.
@@ -108,21 +132,21 @@ class SaescPipeline:
         Returns:
             o3d.geometry.PointCloud: processed drone point cloud
         """
+        # Downsample first, so the SOR neighbor search runs on far fewer points
+        # The SOR parameters are tuned for this density, so revise them if the voxel size changes a lot
+        cloud = cloud.voxel_down_sample(voxel_size=self.drone_voxel_size)
         # Remove SOR noise
         cloud, _ = cloud.remove_statistical_outlier(nb_neighbors=20,
                                                     std_ratio=2.0)
-        points = array(cloud.points)
         # Find the minimum Z that should be close to the water level
-        min_z = np_min(points[:, 2])
-        # Add the sea level reference to ajust the Z values
-        points[:, 2] += sea_level_ref - min_z
-        cloud.points = o3d.utility.Vector3dVector(points)
-        # Calculate the normals, flipping towards positive z
+        min_z = cloud.get_min_bound()[2]
+        # Add the sea level reference to ajust the Z values, translating the cloud in place
+        cloud.translate((0, 0, sea_level_ref - min_z))
+        # Calculate the normals, flipping towards positive z in place
         cloud.estimate_normals(
             search_param=o3d.geometry.KDTreeSearchParamHybrid(radius=0.1, max_nn=30))
-        cloud.normals = o3d.utility.Vector3dVector(
-            array(cloud.normals) * array([1, 1, -1]))
-        return deepcopy(cloud)
+        asarray(cloud.normals)[:, 2] *= -1
+        return cloud
 
     def remove_spikes(self, pcd: o3d.geometry.PointCloud, radius: float, deviation: float) -> o3d.geometry.PointCloud:
         """Remove spikes from the point cloud.
@@ -135,14 +159,21 @@ class SaescPipeline:
         Returns:
             o3d.geometry.PointCloud: processed point cloud
         """
-        # Count neighbors within radius for each point
-        kdtree = o3d.geometry.KDTreeFlann(pcd)
+        if len(pcd.points) == 0:
+            return o3d.geometry.PointCloud()
+        # Count neighbors within radius for each point, searching batches of points at once in a single index
+        # The batches bound the memory used by the neighbor indices of dense clouds
+        points = o3d.core.Tensor.from_numpy(asarray(pcd.points))
+        nns = o3d.core.nns.NearestNeighborSearch(points)
+        nns.fixed_radius_index(radius)
+        batch_size = 100000
         neighbor_counts = []
-        for i in range(len(pcd.points)):
-            [_, idx, _] = kdtree.search_radius_vector_3d(pcd.points[i], radius)
-            neighbor_counts.append(len(idx) - 1)
+        for batch_start in range(0, len(pcd.points), batch_size):
+            _, _, neighbors_splits = nns.fixed_radius_search(
+                points[batch_start:batch_start + batch_size], radius, False)
+            neighbor_counts.append(diff(neighbors_splits.numpy()) - 1)
         # Filter metrics
-        neighbor_counts = array(neighbor_counts)
+        neighbor_counts = concatenate(neighbor_counts)
         median = np_median(neighbor_counts)
         std_dev = np_std(neighbor_counts)
         # Filter points
@@ -163,6 +194,28 @@ class SaescPipeline:
                 highest_ref = ref
         return highest_ref
 
+    def load_process_cloud(self, cloud_index: int, global_sea_level_ref: float) -> o3d.geometry.PointCloud:
+        """Loads and processes one of the input point clouds according to its type.
+
+        Args:
+            cloud_index (int): index of the point cloud in the input data
+            global_sea_level_ref (float): global sea level reference for the drone point clouds
+
+        Returns:
+            o3d.geometry.PointCloud: processed point cloud, None if it could not be loaded
+        """
+        c_path = self.input_clouds_paths[cloud_index]
+        # Load the point cloud
+        cloud = o3d.io.read_point_cloud(
+            c_path) if c_path.endswith(".ply") else self.xyz_to_point_cloud(c_path)
+        if cloud is None:
+            return None
+        # Process the point cloud according to the type
+        if self.input_clouds_types[cloud_index] == "sonar":
+            return self.process_sonar_cloud(
+                cloud=cloud, sea_level_ref=self.sea_level_refs[cloud_index], preprocess_flag=self.preprocess_flags[cloud_index])
+        return self.process_drone_cloud(cloud=cloud, sea_level_ref=global_sea_level_ref)
+
     def merge_clouds(self) -> Generator[dict, None, None]:
         """Merges the point clouds properly into a single point cloud object.
 
@@ -171,51 +224,59 @@ class SaescPipeline:
         """
         if len(self.input_clouds_paths) == 0:
             yield {"status": "Error: no input point clouds were provided", "result": False, "pct": 0}
+            return
+        for c_path, c_type in zip(self.input_clouds_paths, self.input_clouds_types):
+            if c_type not in ["sonar", "drone"]:
+                yield {"status": f"Error: unknown point cloud type {c_type} for point cloud {c_path}", "result": False, "pct": 0}
+                return
 
         # Get the global sea level that we will refer to for drone ptcs
         global_sea_level_ref = self.calculate_global_sea_level_reference()
 
         # Amount of processes to run
         process_count = float(len(self.input_clouds_paths) + 1)
-        pct = 0
 
-        for i in range(len(self.input_clouds_paths)):
-            c_path = self.input_clouds_paths[i]
-            c_type = self.input_clouds_types[i]
-
-            # Initial percentage yield
-            pct = float(i) / process_count
-            yield {"status": f"Processing point cloud {i + 1} out of {len(self.input_clouds_paths)}", "result": True, "pct": pct}
-
-            # Load the point cloud
-            cloud = o3d.io.read_point_cloud(
-                c_path) if c_path.endswith(".ply") else self.xyz_to_point_cloud(c_path)
-            if cloud is None:
-                yield {"status": f"Error: could not load point cloud from {c_path}", "result": False, "pct": 0}
-
-            # Merge the point cloud according to the type
-            if c_type == "unknown":
-                yield {"status": f"Error: unknown point cloud type {c_type} for point cloud {c_path}", "result": False, "pct": 0}
-            elif c_type == "sonar":
-                self.merged_cloud += self.process_sonar_cloud(
-                    cloud=cloud, sea_level_ref=self.sea_level_refs[i], preprocess_flag=self.preprocess_flags[i])
-            elif c_type == "drone":
-                self.merged_cloud += self.process_drone_cloud(
-                    cloud=cloud, sea_level_ref=global_sea_level_ref)
-
-            # Final percentage yield
-            pct = float(i + 1) / process_count
-            yield {"status": f"Processed point cloud {i + 1}!", "result": True, "pct": pct}
+        # The point clouds are independent until merged, so they are loaded and processed in parallel
+        yield {"status": f"Processing {len(self.input_clouds_paths)} point clouds", "result": True, "pct": 0}
+        processed_clouds = [None] * len(self.input_clouds_paths)
+        # Build the colormap here, so the workers only read it and matplotlib is set up from this thread
+        self.get_colormap_lut(self.sonar_colormap_name)
+        with ThreadPoolExecutor(max_workers=min(len(self.input_clouds_paths), self.max_loading_workers)) as executor:
+            futures = {executor.submit(self.load_process_cloud, i, global_sea_level_ref): i
+                       for i in range(len(self.input_clouds_paths))}
+            for processed_count, future in enumerate(as_completed(futures), start=1):
+                i = futures[future]
+                processed_clouds[i] = future.result()
+                if processed_clouds[i] is None:
+                    yield {"status": f"Error: could not load point cloud from {self.input_clouds_paths[i]}", "result": False, "pct": 0}
+                    return
+                # Percentage yield as each cloud is done
+                pct = processed_count / process_count
+                yield {"status": f"Processed point cloud {i + 1}!", "result": True, "pct": pct}
+
+        # Merge the point clouds in the input order, building the merged arrays only once
+        clouds = [cloud for cloud in [self.merged_cloud] + processed_clouds if cloud.has_points()]
+        if clouds:
+            merged_cloud = o3d.geometry.PointCloud(o3d.utility.Vector3dVector(
+                concatenate([asarray(cloud.points) for cloud in clouds])))
+            # Normals and colors are only kept if every cloud has them, as when adding the clouds
+            if all(cloud.has_normals() for cloud in clouds):
+                merged_cloud.normals = o3d.utility.Vector3dVector(
+                    concatenate([asarray(cloud.normals) for cloud in clouds]))
+            if all(cloud.has_colors() for cloud in clouds):
+                merged_cloud.colors = o3d.utility.Vector3dVector(
+                    concatenate([asarray(cloud.colors) for cloud in clouds]))
+            self.merged_cloud = merged_cloud
         yield {"status": "Point cloud was merged succesfully and is ready for download.", "result": True, "pct": 1.0}
 
     def save_merged_cloud(self) -> bool:
-        """Saves the merged point cloud to the output path.
+        """Saves the merged point cloud to the output path, in binary format.
 
         Returns:
             bool: true if the point cloud was saved successfully
         """
-        # Save the merged point cloud
-        if not o3d.io.write_point_cloud(self.output_path, self.merged_cloud):
+        # Save the merged point cloud, binary and uncompressed as the Open3D defaults already are
+        if not o3d.io.write_point_cloud(self.output_path, self.merged_cloud, write_ascii=False, compressed=False, print_progress=False):
             return False
         return True
 
@@ -236,9 +297,11 @@ class SaescPipeline:
         points = asarray(self.merged_cloud.points)
         polydata = PolyData(points)
         if self.merged_cloud.has_colors():
-            colors = (asarray(self.merged_cloud.colors)
-                      * 255).astype(uint8)
-            polydata.point_data["RGB"] = colors
+            # Quantize straight into the uint8 buffer, without a float copy of every color
+            colors = asarray(self.merged_cloud.colors)
+            colors_uint8 = empty(colors.shape, dtype=uint8)
+            multiply(colors, 255, out=colors_uint8, casting="unsafe")
+            polydata.point_data["RGB"] = colors_uint8
         if self.merged_cloud.has_normals():
             normals = asarray(self.merged_cloud.normals)
             polydata.point_data["Normals"] = normals
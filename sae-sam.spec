@@ -21,7 +21,7 @@ a = Analysis(
         'matplotlib.backends.backend_qt5agg',
         'pyvista', 'pyvistaqt', 'PySide6',
         'transformers', 'torch', 'ultralytics', 'onnx', 'onnxruntime',
-        'utm', 'pymavlink',
+        'utm', 'pyproj', 'pymavlink',
         'vtkmodules', 'vtkmodules.all', 'vtkmodules.util', 'vtkmodules.util.data_model', 'vtkmodules.util.execution_model',
         'torch._inductor', 'torch._dynamo'
     ],
@@ -56,16 +56,14 @@ def main() -> None:
             self.background = QPixmap(
                 get_file_placement_path("resources/background.png"))
             palette = QPalette()
-            palette.setBrush(QPalette.Window, QBrush(self.background.scaled(
-                self.size(), Qt.IgnoreAspectRatio, Qt.SmoothTransformation)))
+            palette.setBrush(QPalette.Window, QBrush(get_scaled_background(self.background, self.size())))
             self.setPalette(palette)
 
         def resizeEvent(self, event: None) -> None:
             """Resize the contents when the window is resized.
             """
             # Resizing background
-            scaled_bg = self.background.scaled(
-                self.size(), Qt.IgnoreAspectRatio, Qt.SmoothTransformation)
+            scaled_bg = get_scaled_background(self.background, self.size())
             palette = self.palette()
             palette.setBrush(QPalette.Window, QBrush(scaled_bg))
             self.setPalette(palette)
@@ -236,6 +234,8 @@ def main() -> None:
             event.accept()
 
     app = QApplication()
+    # Room in the pixmap cache for the scaled backgrounds and images of a few window sizes, in KB
+    QPixmapCache.setCacheLimit(32 * 1024)
 
     # Splash screen
     original_pix = QPixmap(get_file_placement_path("resources/saesam.png"))
@@ -278,11 +278,12 @@ if __name__ == '__main__':
         QApplication, QMainWindow, QPushButton, QSplashScreen,
         QHBoxLayout, QVBoxLayout, QLabel, QWidget, QSizePolicy
     )
-    from PySide6.QtGui import QPixmap, QPalette, QBrush, QFont, QGuiApplication
+    from PySide6.QtGui import QPixmap, QPalette, QBrush, QFont, QGuiApplication, QPixmapCache
     from PySide6.QtCore import Qt, QTimer
     from windows.apex_window import ApexWindow
     from windows.dat_window import DatWindow
     from windows.saesc_window import SaescWindow
     from windows.mb2_opt_window import Mb2OptWindow
+    from windows.scaled_background import get_scaled_background
     from modules.path_tool import get_file_placement_path
     main()
@@ -1,16 +1,43 @@
+from os import path
 from PySide6.QtWidgets import (
     QMainWindow, QWidget, QPushButton, QLabel, QFileDialog,
     QTextEdit, QLineEdit, QHBoxLayout, QVBoxLayout, QSplitter
 )
-from PySide6.QtGui import QPixmap, QPalette, QBrush, QResizeEvent
-from PySide6.QtCore import Qt, QThread
-from workers.apex_worker import ApexWorker
+from PySide6.QtGui import QPixmap, QPainter, QPaintEvent, QResizeEvent, QTextCursor, QImageReader, QDoubleValidator, QPixmapCache, QImage, QCloseEvent
+from PySide6.QtCore import Qt, QThread, QTimer, Signal, QSize, QLocale
+from workers.apex_worker import ApexWorker, ApexImageWorker
 from modules.path_tool import get_file_placement_path
 from modules.report_generator import ReportGenerator
 from windows.editable_labels import EditableImageLabel
+from windows.scaled_background import get_background_cache_key, get_scaled_background
+
+
+# Decoded resource pixmaps, shared by every window instance
+PIXMAP_CACHE = dict()
+# File dialogs skip probing every entry for its own icon, which freezes them in big or network folders
+FILE_DIALOG_OPTIONS = QFileDialog.Option.DontUseCustomDirectoryIcons
+
+
+def get_cached_pixmap(relative_path: str) -> QPixmap:
+    """Loads a resource pixmap, decoding the file only the first time it is requested.
+
+    Args:
+        relative_path (str): Relative path to the resource.
+
+    Returns:
+        QPixmap: The resource pixmap.
+    """
+    if relative_path not in PIXMAP_CACHE:
+        PIXMAP_CACHE[relative_path] = QPixmap(
+            get_file_placement_path(relative_path))
+    return PIXMAP_CACHE[relative_path]
 
 
 class ApexWindow(QMainWindow):
+    request_image_save_signal = Signal(object, str, str)
+    request_image_load_signal = Signal(str)
+    request_process_signal = Signal(str, object)
+
     ##############################################################################################
     # region Constructor
     def __init__(self) -> None:
@@ -18,8 +45,7 @@ class ApexWindow(QMainWindow):
         """
         super().__init__()
         self.setWindowTitle("Apex Window")
-        self.setWindowIcon(
-            QPixmap(get_file_placement_path("resources/apex.png")))
+        self.setWindowIcon(get_cached_pixmap("resources/apex.png"))
         self.setGeometry(300, 300, 1500, 900)
 
         # Default values for the window control
@@ -65,6 +91,31 @@ class ApexWindow(QMainWindow):
         splitter.setSizes([self.width() // 2, self.width() // 2])
         main_layout.addWidget(splitter)
 
+        # Setup parallel worker for async image loading and saving
+        self.image_thread = QThread()
+        self.image_worker = ApexImageWorker()
+        self.image_worker.moveToThread(self.image_thread)
+        self.image_worker.log.connect(self.log_output)
+        self.image_worker.finished.connect(self.enable_buttons)
+        self.image_worker.image_loaded_signal.connect(self.on_image_loaded)
+        self.request_image_save_signal.connect(self.image_worker.save_image)
+        self.request_image_load_signal.connect(self.image_worker.load_image)
+        self.image_thread.start()
+        # Setup parallel worker for the pipeline, kept alive so the models stay loaded between runs
+        self.process_thread = QThread()
+        self.worker = ApexWorker()
+        self.worker.moveToThread(self.process_thread)
+        self.worker.log.connect(self.log_output)
+        self.worker.set_segmented_image.connect(self._set_segmented_image)
+        self.worker.set_metrics.connect(self._log_metrics)
+        self.worker.finished.connect(self.enable_buttons)
+        self.request_process_signal.connect(self.worker.run)
+        self.process_thread.start()
+        # Decode the background in the worker the first time a window is opened
+        if self.background is None:
+            self.request_image_load_signal.emit(
+                get_file_placement_path("resources/background.png"))
+
     # endregion
     ##############################################################################################
     # region Setup UI
@@ -84,9 +135,18 @@ class ApexWindow(QMainWindow):
         self.grid_height_input = QLineEdit(self)
         self.grid_width_input = QLineEdit(self)
         self.column_width_input = QLineEdit(self)
+        # Only accept positive numbers, with a dot as decimal separator whatever the system locale
+        dimension_validator = QDoubleValidator(0.0, 1e6, 6, self)
+        dimension_validator.setNotation(QDoubleValidator.StandardNotation)
+        dimension_validator.setLocale(QLocale.c())
         self.grid_height_input.setText("30.0")
         self.grid_width_input.setText("15.618")
         self.column_width_input.setText("5.232")
+        # Parse the default values once, then keep the barrier dimensions updated as the values are edited
+        self.update_barrier_dimensions()
+        for dimension_input in [self.grid_height_input, self.grid_width_input, self.column_width_input]:
+            dimension_input.setValidator(dimension_validator)
+            dimension_input.textChanged.connect(self.update_barrier_dimensions)
         # Place everything side by side
         input_layout.addWidget(self.grid_height_label)
         input_layout.addWidget(self.grid_height_input)
@@ -122,6 +182,16 @@ class ApexWindow(QMainWindow):
         self.output_panel = QTextEdit(self)
         self.output_panel.setReadOnly(True)
         self.output_panel.setPlaceholderText("Log output")
+        # Keep only the latest log lines, dropping the oldest ones
+        self.output_panel.document().setMaximumBlockCount(2000)
+        # Cursor used to write the logs at the end of the panel document
+        self.log_cursor = QTextCursor(self.output_panel.document())
+        # Messages waiting to be written, flushed together at most every 50 ms
+        self.log_buffer = []
+        self.log_timer = QTimer(self)
+        self.log_timer.setSingleShot(True)
+        self.log_timer.setInterval(50)
+        self.log_timer.timeout.connect(self.flush_log_output)
         # Add the process layout to the parameter layout
         layout.addLayout(process_layout)
         layout.addWidget(self.output_panel)
@@ -153,12 +223,81 @@ class ApexWindow(QMainWindow):
     def setup_background(self) -> None:
         """Generates the background with proper image and scales
         """
-        self.background = QPixmap(
-            get_file_placement_path("resources/background.png"))
-        palette = QPalette()
-        palette.setBrush(QPalette.Window, QBrush(self.background.scaled(
-            self.size(), Qt.IgnoreAspectRatio, Qt.SmoothTransformation)))
-        self.setPalette(palette)
+        # Only available right away if a previous window already loaded it, otherwise it is loaded in background
+        self.background = PIXMAP_CACHE.get("resources/background.png")
+        # Last scaled background and the window size it was scaled to
+        self.scaled_background = None
+        self.scaled_background_size = None
+        # Resize events come in bursts while dragging, so the background is only rescaled once they settle
+        self.background_timer = QTimer(self)
+        self.background_timer.setSingleShot(True)
+        self.background_timer.setInterval(50)
+        self.background_timer.timeout.connect(self.update_background)
+        # Once the size settles, the fast scaled background is replaced by a smooth one
+        self.smooth_background_timer = QTimer(self)
+        self.smooth_background_timer.setSingleShot(True)
+        self.smooth_background_timer.setInterval(150)
+        self.smooth_background_timer.timeout.connect(
+            self.update_smooth_background)
+        self.update_background()
+
+    def update_background(self) -> None:
+        """Rescales the background to the window size, if it changed, and repaints the window
+        """
+        if self.background is None or self.scaled_background_size == self.size():
+            return
+        self.scaled_background_size = self.size()
+        # Reuse the smooth background if this size was already scaled before
+        cached_background = QPixmapCache.find(
+            get_background_cache_key(self.scaled_background_size))
+        if cached_background is not None and not cached_background.isNull():
+            self.scaled_background = cached_background
+        else:
+            # Fast scale for immediate feedback, the smooth one comes later
+            self.scaled_background = self.background.scaled(
+                self.scaled_background_size, Qt.IgnoreAspectRatio, Qt.FastTransformation)
+            self.smooth_background_timer.start()
+        self.update()
+
+    def update_smooth_background(self) -> None:
+        """Replaces the fast scaled background by a smooth one, if the window size did not change meanwhile
+        """
+        if self.scaled_background_size != self.size():
+            return
+        self.scaled_background = get_scaled_background(
+            self.background, self.scaled_background_size)
+        self.update()
+
+    def on_image_loaded(self, image_path: str, image: QImage) -> None:
+        """Slot for the worker thread responding that the background load is completed
+
+        Args:
+            image_path (str): The path of the loaded image.
+            image (QImage): The loaded image.
+        """
+        # The pixmap is only created here, since QPixmap must stay in the GUI thread
+        self.background = QPixmap.fromImage(image)
+        PIXMAP_CACHE["resources/background.png"] = self.background
+        self.scaled_background_size = None
+        self.update_background()
+
+    def paintEvent(self, event: QPaintEvent) -> None:
+        """Draws the background directly, instead of through a palette brush
+
+        Args:
+            event (QPaintEvent): The paint event.
+        """
+        if self.background is None:
+            super().paintEvent(event)
+            return
+        painter = QPainter(self)
+        if self.scaled_background_size == self.size():
+            painter.drawPixmap(0, 0, self.scaled_background)
+        else:
+            # Still resizing, stretch the original background until the scaled one is updated
+            painter.drawPixmap(self.rect(), self.background)
+        painter.end()
+        super().paintEvent(event)
 
     def resizeEvent(self, event: QResizeEvent) -> None:
         """Resizes the window and all the elements in it when resize callback is called
@@ -166,21 +305,24 @@ class ApexWindow(QMainWindow):
         Args:
             event (QResizeEvent): The resize event.
         """
-        # Rescale background
-        scaled_bg = self.background.scaled(
-            self.size(), Qt.IgnoreAspectRatio, Qt.SmoothTransformation
-        )
-        palette = self.palette()
-        palette.setBrush(QPalette.Window, QBrush(scaled_bg))
-        self.setPalette(palette)
+        # Rescale background after the last resize event of the burst, skipping sizes it already has
+        if event.size() != self.scaled_background_size:
+            self.background_timer.start()
         # Call the base class method
         super().resizeEvent(event)
 
-    def destroyEvent(self) -> None:
-        """Handles the destruction of the window and cleans up resources
+    def closeEvent(self, event: QCloseEvent) -> None:
+        """Stops the worker threads before the window is closed and deleted
+
+        Args:
+            event (QCloseEvent): The close event.
         """
-        self.editable_image_label.text_labels.clear()
-        super().destroyEvent()
+        # Make sure the worker threads are cleanly stopped
+        self.image_thread.quit()
+        self.image_thread.wait()
+        self.process_thread.quit()
+        self.process_thread.wait()
+        super().closeEvent(event)
 
     # endregion
     ##############################################################################################
@@ -191,13 +333,23 @@ class ApexWindow(QMainWindow):
         self.disable_buttons()
         self.log_output(self.skip_print)
         self.image_path, _ = QFileDialog.getOpenFileName(
-            self, "Open Image", "", "Image Files (*.png *.jpg *.jpeg)"
+            self, "Open Image", "", "Image Files (*.png *.jpg *.jpeg)",
+            options=FILE_DIALOG_OPTIONS
         )
         if self.image_path:
-            filename = self.image_path.split("/")[-1]
+            filename = path.basename(self.image_path)
             self.log_output(f"Loaded image: {filename}")
             self.load_image_text_box.setText(filename)
-            self.image_original = QPixmap(self.image_path)
+            # Decode the image straight at the preview size, the pipeline reads the full image from its path
+            image_reader = QImageReader(self.image_path)
+            # Apply the EXIF orientation, as the pipeline image reading does
+            image_reader.setAutoTransform(True)
+            image_size = image_reader.size()
+            preview_size = self.get_preview_size()
+            if image_size.width() > preview_size.width() or image_size.height() > preview_size.height():
+                image_reader.setScaledSize(image_size.scaled(
+                    preview_size, Qt.KeepAspectRatio))
+            self.image_original = QPixmap.fromImage(image_reader.read())
             self.image_panel_state = "original"
             self.editable_image_label.set_image(
                 image=self.image_original, state=self.image_panel_state)
@@ -217,37 +369,44 @@ class ApexWindow(QMainWindow):
             self.log_output("No image loaded.")
             self.enable_buttons()
             return
-        try:
-            grid_height = float(self.grid_height_input.text())
-            grid_width = float(self.grid_width_input.text())
-            column_width = float(self.column_width_input.text())
-        except ValueError:
+        if not self.barrier_dimensions:
             self.log_output("Invalid input for dimensions.")
+            self.enable_buttons()
             return
-        barrier_dimensions = {
-            "grid_width": grid_width,
-            "grid_height": grid_height,
-            "collumn_width": column_width
-        }
-        # Deal with parallelism in the worker thread to run the pipeline
-        self.thread = QThread()
-        self.worker = ApexWorker(self.image_path, barrier_dimensions)
-        self.worker.moveToThread(self.thread)
-        self.thread.started.connect(self.worker.run)
-        self.worker.log.connect(self.log_output)
-        self.worker.set_segmented_image.connect(self._set_segmented_image)
-        self.worker.set_metrics.connect(self._log_metrics)
-        self.worker.finished.connect(self.thread.quit)
-        self.worker.finished.connect(self.worker.deleteLater)
-        self.thread.finished.connect(self.thread.deleteLater)
-        self.thread.finished.connect(self.enable_buttons)
-        self.thread.start()
+        # Run the pipeline in the worker thread, it enables the buttons when done
+        self.request_process_signal.emit(
+            self.image_path, self.barrier_dimensions)
+
+    def get_preview_size(self) -> QSize:
+        """Size the displayed images are kept at, twice the panel size so they can still be shown if the window grows
+
+        Returns:
+            QSize: The preview size.
+        """
+        return self.editable_image_label.size() * 2
+
+    def update_barrier_dimensions(self) -> None:
+        """Parses the barrier dimensions whenever one of the inputs is edited, None while any of them is invalid
+        """
+        try:
+            self.barrier_dimensions = {
+                "grid_width": float(self.grid_width_input.text()),
+                "grid_height": float(self.grid_height_input.text()),
+                "collumn_width": float(self.column_width_input.text())
+            }
+        except ValueError:
+            self.barrier_dimensions = None
 
     def _set_segmented_image(self, image: QPixmap) -> None:
         """Callback for the segmented image
         Args:
             image (QPixmap): The segmented image to be displayed
         """
+        # Keep only a preview of the full resolution result, the display rescales then start from it
+        preview_size = self.get_preview_size()
+        if image.width() > preview_size.width() or image.height() > preview_size.height():
+            image = image.scaled(
+                preview_size, Qt.KeepAspectRatio, Qt.SmoothTransformation)
         self.image_segmented = QPixmap.fromImage(image)
         if self.image_segmented.isNull():
             self.log_output("Failed to generate segmented image.")
@@ -263,18 +422,21 @@ class ApexWindow(QMainWindow):
         Args:
             metrics (tuple): the metrics per detection and per class
         """
-        self.log_output(self.skip_print)
-        self.log_output(self.skip_print)
+        # Build every line first and log them as a single message
+        lines = [self.skip_print, self.skip_print]
         if metrics:
             self.output_metrics = metrics
             metrics_per_detection = metrics[0]
-            self.log_output("Metrics:")
-            for i, metric in enumerate(metrics_per_detection):
-                self.log_output(self.skip_print)
-                self.log_output(
-                    f" Detection {i}: class {metric['class']}, area: {metric['area']} m2, volume: {metric['volume']} m3")
+            lines.append("Metrics:")
+            for i, (detection_class, area, volume) in enumerate(zip(metrics_per_detection["class"].tolist(),
+                                                                    metrics_per_detection["area"].tolist(),
+                                                                    metrics_per_detection["volume"].tolist())):
+                lines.append(self.skip_print)
+                lines.append(
+                    f" Detection {i}: class {detection_class}, area: {area} m2, volume: {volume} m3")
         else:
-            self.log_output("No metrics detected.")
+            lines.append("No metrics detected.")
+        self.log_output("\n".join(lines))
 
     def log_output(self, message: str) -> None:
         """Logs the output in the text panel
@@ -282,7 +444,22 @@ class ApexWindow(QMainWindow):
         Args:
             message (str): The message to be logged
         """
-        self.output_panel.append(message)
+        # Messages arriving in bursts are written to the panel together
+        self.log_buffer.append(message)
+        if not self.log_timer.isActive():
+            self.log_timer.start()
+
+    def flush_log_output(self) -> None:
+        """Writes the buffered messages to the text panel at once
+        """
+        # Insert the new lines at the end of the document and keep them in view
+        self.log_cursor.movePosition(QTextCursor.End)
+        if not self.output_panel.document().isEmpty():
+            self.log_cursor.insertBlock()
+        self.log_cursor.insertText("\n".join(self.log_buffer))
+        self.log_buffer.clear()
+        scroll_bar = self.output_panel.verticalScrollBar()
+        scroll_bar.setValue(scroll_bar.maximum())
 
     def toggle_btn_callback(self) -> None:
         """Callback for the toggle image btn
@@ -308,14 +485,17 @@ class ApexWindow(QMainWindow):
         self.disable_buttons()
         self.log_output(self.skip_print)
         save_path, _ = QFileDialog.getSaveFileName(
-            self, "Save Image As", "output.png", "PNG Files (*.png);;JPEG Files (*.jpg *.jpeg)"
+            self, "Save Image As", "output.png", "PNG Files (*.png);;JPEG Files (*.jpg *.jpeg)",
+            options=FILE_DIALOG_OPTIONS
         )
         if save_path:
             painted_image = self.editable_image_label.get_painted_image(
                 state=self.image_panel_state)
-            painted_image.save(save_path)
-            self.log_output(
-                f"{self.image_panel_state} image saved to {save_path}")
+            # Encode the image in the worker thread, it enables the buttons when done
+            self.log_output(f"Saving {self.image_panel_state} image...")
+            self.request_image_save_signal.emit(
+                painted_image.toImage(), save_path, self.image_panel_state)
+            return
         self.enable_buttons()
 
     def download_report_btn_callback(self) -> None:
@@ -329,12 +509,13 @@ class ApexWindow(QMainWindow):
             return
         # Get the save path for the report
         save_path, _ = QFileDialog.getSaveFileName(
-            self, "Save Report As", "report.pdf", "PDF Files (*.pdf)"
+            self, "Save Report As", "report.pdf", "PDF Files (*.pdf)",
+            options=FILE_DIALOG_OPTIONS
         )
         self.report_generator.set_output_path(save_path)
         # Creating the report data on top of the output metrics
         report_data = {
-            "image_name": self.image_path.split("/")[-1],
+            "image_name": path.basename(self.image_path),
             "model_name": "distill_any_depth",
             "original_image": self.editable_image_label.get_painted_image(state="original"),
             "segmented_image": self.editable_image_label.get_painted_image(state="segmented"),
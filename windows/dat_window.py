@@ -6,6 +6,7 @@ from PySide6.QtWidgets import (
 from PySide6.QtGui import QPixmap, QPalette, QBrush, QResizeEvent, QPainter, QColor, QPen, QPaintEvent, QMouseEvent, QImage
 from PySide6.QtCore import Qt, QThread, Signal, Slot
 from modules.path_tool import get_file_placement_path
+from windows.scaled_background import get_scaled_background
 from windows.son_proc_label import SonProcLabel
 from workers.dat_worker import DatWorker
 import numpy as np
@@ -573,8 +574,7 @@ class DatWindow(QMainWindow):
         self.background = QPixmap(
             get_file_placement_path("resources/background.png"))
         palette = QPalette()
-        palette.setBrush(QPalette.Window, QBrush(self.background.scaled(
-            self.size(), Qt.IgnoreAspectRatio, Qt.SmoothTransformation)))
+        palette.setBrush(QPalette.Window, QBrush(get_scaled_background(self.background, self.size())))
         self.setPalette(palette)
 
     def resizeEvent(self, event: QResizeEvent) -> None:
@@ -584,9 +584,7 @@ class DatWindow(QMainWindow):
             event (QResizeEvent): The resize event.
         """
         # Rescale background
-        scaled_bg = self.background.scaled(
-            self.size(), Qt.IgnoreAspectRatio, Qt.SmoothTransformation
-        )
+        scaled_bg = get_scaled_background(self.background, self.size())
         palette = self.palette()
         palette.setBrush(QPalette.Window, QBrush(scaled_bg))
         self.setPalette(palette)
@@ -2,7 +2,7 @@ from PySide6.QtWidgets import (
     QLabel, QLineEdit, QWidget, QSizePolicy
 )
 from PySide6.QtGui import (
-    QPixmap, QPainter, QFont, QMouseEvent, QResizeEvent
+    QPixmap, QPainter, QFont, QMouseEvent, QResizeEvent, QPixmapCache
 )
 from PySide6.QtCore import Qt, QPoint, QPointF
 
@@ -80,6 +80,8 @@ class EditableImageLabel(QLabel):
         # Image data
         self.image_original_pixmap = None
         self.image_segmented_pixmap = None
+        # Last scaled pixmap per state, with the source pixmap and label size it was scaled from
+        self.scaled_pixmaps_cache = dict()
         # Font and style settings
         self.setStyleSheet(
             "border: 1px solid white; background-color: rgba(0,0,0,50);")
@@ -100,9 +102,28 @@ class EditableImageLabel(QLabel):
             image (QPixmap): The image to set.
             state (str): The state of the image ("original" or "segmented").
         """
-        # Define the image based on the state
-        image_scaled = image.scaled(
-            self.size(), Qt.AspectRatioMode.KeepAspectRatio, Qt.TransformationMode.SmoothTransformation)
+        # Define the image based on the state, scaling only if the image or the label size changed
+        cache_key = (image.cacheKey(), self.width(), self.height())
+        cached_key, image_scaled = self.scaled_pixmaps_cache.get(
+            state, (None, None))
+        if cached_key != cache_key:
+            # Sizes shown before, e.g. when the window is resized back, are kept in the global pixmap cache
+            image_scaled = QPixmapCache.find(self.get_scaled_cache_key(cache_key))
+        if cached_key != cache_key and (image_scaled is None or image_scaled.isNull()):
+            target_size = image.size().scaled(
+                self.size(), Qt.AspectRatioMode.KeepAspectRatio)
+            if target_size == image.size():
+                # Already at the label size, nothing to scale
+                image_scaled = image
+            elif abs(target_size.width() - image.width()) < 0.02 * target_size.width():
+                # Almost the same size, smoothing would not be visible
+                image_scaled = image.scaled(
+                    target_size, Qt.AspectRatioMode.IgnoreAspectRatio, Qt.TransformationMode.FastTransformation)
+            else:
+                image_scaled = image.scaled(
+                    target_size, Qt.AspectRatioMode.IgnoreAspectRatio, Qt.TransformationMode.SmoothTransformation)
+            QPixmapCache.insert(self.get_scaled_cache_key(cache_key), image_scaled)
+        self.scaled_pixmaps_cache[state] = (cache_key, image_scaled)
         if state == "original":
             self.image_original_pixmap = image_scaled
         elif state == "segmented":
@@ -111,6 +132,17 @@ class EditableImageLabel(QLabel):
         # Update the image state
         self.set_image_state(state)
 
+    def get_scaled_cache_key(self, cache_key: tuple) -> str:
+        """Key of a scaled image in the global pixmap cache.
+
+        Args:
+            cache_key (tuple): The source pixmap cache key and the label width and height.
+
+        Returns:
+            str: The pixmap cache key.
+        """
+        return "editable_image_{}_{}x{}".format(*cache_key)
+
     def set_image_state(self, state: str) -> None:
         """Set the image state to either "original" or "segmented".
 
@@ -7,6 +7,7 @@ from PySide6.QtCore import Qt, QThread, QTimer
 from os import path, listdir
 from workers.mb2_opt_worker import Mb2OptWorker
 from modules.path_tool import get_file_placement_path
+from windows.scaled_background import get_scaled_background
 
 
 class Mb2OptWindow(QMainWindow):
@@ -96,8 +97,7 @@ class Mb2OptWindow(QMainWindow):
         self.background = QPixmap(
             get_file_placement_path("resources/background.png"))
         palette = QPalette()
-        palette.setBrush(QPalette.Window, QBrush(self.background.scaled(
-            self.size(), Qt.IgnoreAspectRatio, Qt.SmoothTransformation)))
+        palette.setBrush(QPalette.Window, QBrush(get_scaled_background(self.background, self.size())))
         self.setPalette(palette)
 
     def setup_input_data_section(self, left_layout: QVBoxLayout) -> None:
@@ -227,8 +227,7 @@ class Mb2OptWindow(QMainWindow):
         """Resize the contents when the window is resized.
         """
         # Rescale background
-        scaled_bg = self.background.scaled(
-            self.size(), Qt.IgnoreAspectRatio, Qt.SmoothTransformation)
+        scaled_bg = get_scaled_background(self.background, self.size())
         palette = self.palette()
         palette.setBrush(QPalette.Window, QBrush(scaled_bg))
         self.setPalette(palette)
@@ -10,6 +10,7 @@ from os import path
 import open3d as o3d
 from workers.saesc_worker import SaescWorker
 from modules.path_tool import get_file_placement_path
+from windows.scaled_background import get_scaled_background
 
 
 ##############################################################################################
@@ -182,16 +183,14 @@ class SaescWindow(QMainWindow):
         self.background = QPixmap(
             get_file_placement_path("resources/background.png"))
         palette = QPalette()
-        palette.setBrush(QPalette.Window, QBrush(self.background.scaled(
-            self.size(), Qt.IgnoreAspectRatio, Qt.SmoothTransformation)))
+        palette.setBrush(QPalette.Window, QBrush(get_scaled_background(self.background, self.size())))
         self.setPalette(palette)
 
     def resizeEvent(self, event: None) -> None:
         """Resize the contents when the window is resized.
         """
         # Rescale background
-        scaled_bg = self.background.scaled(
-            self.size(), Qt.IgnoreAspectRatio, Qt.SmoothTransformation)
+        scaled_bg = get_scaled_background(self.background, self.size())
         palette = self.palette()
         palette.setBrush(QPalette.Window, QBrush(scaled_bg))
         self.setPalette(palette)
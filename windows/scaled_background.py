@@ -0,0 +1,33 @@
+from PySide6.QtGui import QPixmap, QPixmapCache
+from PySide6.QtCore import Qt, QSize
+
+
+def get_background_cache_key(size: QSize) -> str:
+    """Key of the smooth background for a window size in the pixmap cache, shared by every window
+
+    Args:
+        size (QSize): The window size.
+
+    Returns:
+        str: The cache key.
+    """
+    return f"background_{size.width()}x{size.height()}"
+
+
+def get_scaled_background(background: QPixmap, size: QSize) -> QPixmap:
+    """Scales the background to the window size, reusing the pixmap cache for sizes scaled before
+
+    Args:
+        background (QPixmap): The original background.
+        size (QSize): The window size.
+
+    Returns:
+        QPixmap: The scaled background.
+    """
+    cache_key = get_background_cache_key(size)
+    scaled_background = QPixmapCache.find(cache_key)
+    if scaled_background is None or scaled_background.isNull():
+        scaled_background = background.scaled(
+            size, Qt.IgnoreAspectRatio, Qt.SmoothTransformation)
+        QPixmapCache.insert(cache_key, scaled_background)
+    return scaled_background
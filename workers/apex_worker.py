@@ -1,8 +1,9 @@
 from PySide6.QtCore import QObject, Signal, Slot
-from PySide6.QtGui import QImage
-from PIL.ImageQt import ImageQt
-from modules.apex_pipeline import ApexPipeline
-from modules.path_tool import get_file_placement_path
+from PySide6.QtGui import QImage, QImageWriter
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from modules.apex_pipeline import ApexPipeline
 
 
 class ApexWorker(QObject):
@@ -12,40 +13,87 @@ class ApexWorker(QObject):
     set_segmented_image = Signal(QImage)
     set_metrics = Signal(tuple)
 
-    def __init__(self, image_path: str, barrier_dimensions: dict) -> None:
-        """Initialize the worker with the pipeline and image path.
+    def __init__(self, apex_pipeline: "ApexPipeline" = None) -> None:
+        """Initialize the worker, kept alive in its thread to process every image.
 
         Args:
-            image_path (str): The path to the image to be processed.
-            barrier_dimensions (dict): The dimensions of the barriers in the image.
+            apex_pipeline (ApexPipeline, optional): Pipeline to run, created on the first run if not given. Defaults to None.
         """
         super().__init__()
-        # Initialize the pipeline with a pixel ratio
-        self.apex_pipeline = ApexPipeline(undistort_m_pixel_ratio=0.1)
-        self.image_path = image_path
-        self.barrier_dimensions = barrier_dimensions
+        self.apex_pipeline = apex_pipeline
 
-    @Slot()
-    def run(self) -> None:
+    @Slot(str, object)
+    def run(self, image_path: str, barrier_dimensions: dict) -> None:
         """Run the image processing pipeline.
         This method emits logs and signals during the processing.
+
+        Args:
+            image_path (str): The path to the image to be processed.
+            barrier_dimensions (dict): The dimensions of the barriers in the image.
         """
+        # Initialize the pipeline with a pixel ratio on the first run, keeping the models loaded between runs
+        # The pipeline modules (torch, YOLO, transformers) are only imported here, so the window opens fast
+        if self.apex_pipeline is None:
+            from modules.apex_pipeline import ApexPipeline
+            self.apex_pipeline = ApexPipeline(undistort_m_pixel_ratio=0.1)
         # Emitting log messages to indicate the progress of the pipeline
         self.log.emit("Setting up image and parameters...")
         self.apex_pipeline.set_barrier_dimensions(
-            barrier_dimensions=self.barrier_dimensions)
+            barrier_dimensions=barrier_dimensions)
         self.log.emit("Loading image and processing pipeline...")
         # Running the pipeline and emitting progress updates
-        for state in self.apex_pipeline.run(self.image_path):
+        for state in self.apex_pipeline.run(image_path):
             self.log.emit(f"Progress: {state[0]}%, Status: {state[1]}")
-        # Getting the segmented image and emitting it as a signal
-        segmented = self.apex_pipeline.get_segmented_image()
-        if segmented:
-            image_qt = ImageQt(segmented)
-            qimage = QImage(image_qt)
+        # Getting the segmented image and emitting it as a signal, wrapping the array directly
+        # The QImage is copied once, since the pipeline reuses the array in the next run
+        segmented = self.apex_pipeline.get_segmented_ndarray()
+        if segmented is not None:
+            height, width = segmented.shape[:2]
+            qimage = QImage(segmented.data, width, height,
+                            segmented.strides[0], QImage.Format_RGB888).copy()
             self.set_segmented_image.emit(qimage)
         self.log.emit("Processing complete!")
         # Getting the detection metrics and emitting them as a signal
         metrics_per_detection, metrics_per_class = self.apex_pipeline.get_detections_metrics()
         self.set_metrics.emit((metrics_per_detection, metrics_per_class))
         self.finished.emit()
+
+
+class ApexImageWorker(QObject):
+    # Declaring Signals at the class level
+    finished = Signal()
+    log = Signal(str)
+    image_loaded_signal = Signal(str, object)  # image path, QImage
+
+    @Slot(str)
+    def load_image(self, image_path: str) -> None:
+        """Decodes the image in background and emits it, so the window does not hang.
+
+        Args:
+            image_path (str): The path of the image to be loaded.
+        """
+        image = QImage(image_path)
+        if image.isNull():
+            self.log.emit(f"Failed to load image from {image_path}")
+            return
+        self.image_loaded_signal.emit(image_path, image)
+
+    @Slot(object, str, str)
+    def save_image(self, image: QImage, save_path: str, image_state: str) -> None:
+        """Encodes and saves the image in background, so the window does not hang.
+
+        Args:
+            image (QImage): The image to be saved.
+            save_path (str): The path to save the image to.
+            image_state (str): Which image is being saved, for the log.
+        """
+        image_writer = QImageWriter(save_path)
+        # Lighter PNG compression, a bit bigger file for a much faster encoding
+        if save_path.lower().endswith(".png"):
+            image_writer.setCompression(1)
+        if image_writer.write(image):
+            self.log.emit(f"{image_state} image saved to {save_path}")
+        else:
+            self.log.emit(
+                f"Failed to save {image_state} image: {image_writer.errorString()}")
+        self.finished.emit()